@@ -1,65 +1,144 @@
-import winsound, shutil, math, os, re
-from tqdm import tqdm
-
-from rich.progress import Progress, track
-from rich.console import Console
-from rich.theme import Theme
-from rich.table import Table
+import contextlib, threading, argparse, queue, time, sys, os
 
 from utils.config import Config
+from utils.console import get_console
+from utils.move_engine import MoveEngine
+from utils.transfer import TransferCancelled
+from utils.filesystem import OSFileSystem
+from utils.scan_index import ScanIndex
+from utils.tree_walk import TreeWalk
+from utils.dest_index import DestinationIndex
+from utils.plan import write_plan, read_plan, unchanged
+from utils.metrics import Metrics
+from utils.sniff import Sniffer
+from utils.journal import Journal, read_runs, recover_move, compact
+from utils.progress import Progress, bar_callback
+from utils.retention import DeadlineHeap
+from utils.records import QueueEntry, DestinationTable
+from utils.manifest import Manifest, read_manifest
+from utils.sharding import Sharder
 from utils.utils import Utils
 
 
 class Cleaner(Utils):
 
-    config = Config()
-
-    # rich console
-    custom_theme = Theme(
-        {
-            "primary": "bold deep_sky_blue1",
-            "secondary": "bold pale_turquoise1",
-            # error
-            "info": "dim cyan",
-            "warning": "bold magenta",
-            "danger": "bold red",
-        }
-    )
-    console = Console(theme=custom_theme)
+    # created on first use so importing this module stays fast
+    config = None
+    _console = None
+
+    def __init__(self, config=None, fs=None) -> None:
+        """
+        Keyword arguments:
+
+        config -- path to a config file, defaults to config.json
+
+        fs -- backend from utils.filesystem that the watched and destination folders are
+        read and changed through, defaults to the real OS
+        """
+        if config or self.config is None:
+            self.config = Config(config)
+        self.fs = fs or OSFileSystem()
+        # guards destination setup while several moves run at once
+        self.move_lock = threading.Lock()
+        # names in each destination folder, listed once per run
+        self.dest_index = DestinationIndex(fs=self.fs)
+        # set on cancel so copies in progress stop and remove their partial file
+        self.cancel_event = threading.Event()
+        # tree walks of the folders being scanned recursively by folder path
+        self.tree_walks = {}
+        # set during a scan when sniff_content is enabled
+        self.sniffer = None
+        # picks the subfolders of destinations with a destination_sharding rule
+        self.sharder = None
+        # files matching delete_def found by the last scan
+        self.delete_candidates = []
+        # files a scan that does not expire them found past their retention rule
+        self.expired_files = []
+        # ask, delete or keep for deletion candidates
+        self.delete_policy = "ask"
+        # bandwidth limiter of each destination device and destination folder
+        self.limiters = {}
+        self.dest_limiters = {}
+        # set by --low-priority to run in the background even if the config does not
+        self.low_io_priority = False
+        # set by --organize to link files instead of moving them whatever organize_mode is
+        self.organize_mode = None
+        # scan index of the last scan, updated as organized files are placed
+        self.scan_index = None
+        # functions called with the progress events of utils.progress.Progress while files
+        # move, so a daemon or GUI can follow a run without tqdm
+        self.progress_callbacks = []
+        self.progress = None
+        # one shared copy of each destination path for the queue entries
+        self.destinations = DestinationTable()
+        # writes moved files while a run is in progress, set by --manifest or manifest_path
+        self.manifest = None
+        self.manifest_path = None
+        self.manifest_rows = 0
+        self.manifest_moved = 0
+        # records moves while a run is in progress when journal is enabled
+        self.journal = None
+        # timings and counters for the run and where to write them
+        self.metrics = Metrics(self.fs.device_id)
+        self.metrics_path = None
+        self.prometheus_path = None
 
-    def __init__(self) -> None:
-        pass
+    @property
+    def console(self):
+        """
+        Console used for styled output, created the first time something is printed.
+        """
+        if Cleaner._console is None:
+            Cleaner._console = get_console()
+        return Cleaner._console
+
+    @staticmethod
+    def ask(question) -> str:
+        """
+        Asks the user a question and returns the answer. Returns an empty answer
+        right away when there is no terminal to answer from, such as under cron.
+        """
+        if not sys.stdin or not sys.stdin.isatty():
+            return ""
+        return input(question)
+
+    def progress_bar(self, **kwargs):
+        """
+        Returns a tqdm progress bar or None if it is disabled in the config or not installed.
+        """
+        if not self.config.progress_bar:
+            return None
+        try:
+            from tqdm import tqdm
+        except ModuleNotFoundError:
+            print("Please disable progress bar in config or install the module via Pip.")
+            return None
+        return tqdm(
+            ascii=self.config.ascii, unit="byte", unit_scale=1, dynamic_ncols=1, **kwargs
+        )
 
-    def destination_check(self):
+    def destination_check(self, interactive=True):
         """
         Checks all the destinations in the config file to be sure that all but
         the last folder in each destination exists. If the last folder is
         all that is missing, it will be created during the move process.
+
+        interactive -- asks whether to continue when destinations are missing
         """
         print(f"\nMaking sure file destinations are valid")
         missing_dests = []
-        dir_list = [
-            self.config.file_group_dest,
-            self.config.special_case_dest,
-            self.config.keywords_dest,
-        ]
-        for dirs in dir_list:
-            for dest in dirs.values():
-                if dest == "skip":
-                    continue
-                if type(dest) == list:
-                    dest = dest[1]
-                directory = os.path.dirname(dest)
-                if not os.path.exists(directory):
-                    if dest not in missing_dests:
-                        print(dest)
-                        missing_dests.append(dest)
+        # includes the destinations of watched folders with their own rules
+        for dest in sorted(self.config.all_destinations()):
+            directory = os.path.dirname(dest)
+            if not self.fs.exists(directory):
+                print(dest)
+                missing_dests.append(dest)
         if len(missing_dests) > 0:
             msg = "\n> The below base directories are missing.\n"
             self.console.print(msg, style="secondary")
             for dest in missing_dests:
                 print(dest)
-            if input("\nDo you want to continue?").lower() in ["no", "n"]:
+            if interactive and self.ask("\nDo you want to continue?").lower() in ["no", "n"]:
                 exit()
         else:
             self.console.print("> All destinations are valid.", style="secondary")
@@ -69,13 +148,16 @@ class Cleaner(Utils):
     def get_file_type(file_name):
         """
         Gets file type from the given file name. It only uses the last period separating extension.
+        Names without a period have no file type.
         """
         file_type = ""
+        if "." not in file_name:
+            return file_type
         split_string = file_name.split(".")
         file_type = f".{split_string[-1]}"
         return file_type
 
-    def set_destination(self, file_name):
+    def set_destination(self, file_name, file_type=None, rules=None):
         """
         This function looks for matches in file extensions and keywords.
         It sets the destination for the file or sets it to skip if the file was deleted.
@@ -83,71 +165,363 @@ class Cleaner(Utils):
         Keyword arguments:
 
         file -- file that is being checked for file extension and keyword matches
+
+        file_type -- file type to use instead of the one in the name, such as a sniffed one
+
+        rules -- rule index of the watched folder the file is in, defaults to the config rules
         """
-        file_type = self.get_file_type(file_name)
-        destination = "skip"
-        # for loop that checks for file group matches
-        for file_group, file_type_list in self.config.file_type_groups.items():
-            if file_type in file_type_list:
-                # sets destination based on file group
-                destination = self.config.file_group_dest[file_group]
-                if file_type in self.config.special_case_dest:
-                    # sets destination based on special case
-                    destination = self.config.special_case_dest[file_type]
-                # for loop that checks for keyword matches
-                for keyword, keyword_data in self.config.keywords_dest.items():
-                    # checks for match with upper case removed
-                    if keyword.lower() in file_name.lower():
-                        if file_type in keyword_data[0]:
-                            destination = keyword_data[1]
-                        elif file_group == keyword_data[0][0]:
-                            destination = keyword_data[1]
+        if file_type == None:
+            file_type = self.get_file_type(file_name)
+        if rules == None:
+            rules = self.config.rules
+        # uses the rule index compiled during config setup
+        destination = rules.classify(file_name, file_type)
+        if destination == "skip":
+            return
         # checks if file was moved previously and cancels move
-        if destination == "skip" or os.path.exists(
-            os.path.join(destination, file_name)
+        if self.dest_index.policy == "skip" and self.dest_index.contains(
+            destination, file_name
         ):
             return
         # end destination for file entered as file argument
         return destination
 
+    def queue_entry(self, file_name, path, file_size=None, stat=None, folder=None):
+        """
+        Returns the move_queue entry for a file or None if it should not be moved.
+        When sniffing is on, files whose extension matches no rule are classified
+        by the type found in their header instead.
+
+        folder -- WatchedFolder the file is in, defaults to the first one
+        """
+        start = time.perf_counter()
+        if folder == None:
+            folder = self.config.folders[0]
+        file_type = self.get_file_type(file_name)
+        if self.sniffer and folder.rules.file_group(file_type) == None:
+            sniffed_type = self.sniffer.sniff(path, stat)
+            if sniffed_type:
+                self.metrics.count("files_sniffed")
+                file_type = sniffed_type
+        destination = self.set_destination(file_name, file_type, folder.rules)
+        if destination != None and self.sharder:
+            destination = self.sharder.shard(destination, file_name, stat, path)
+        self.metrics.add_time("classify", time.perf_counter() - start)
+        if destination == None:
+            return
+        if file_size == None:
+            file_size = self.fs.stat(path).st_size
+        return QueueEntry(path, file_size, self.destinations.intern(destination), folder)
+
+    def check_retention(self, file_name, stat, folder=None):
+        """
+        Applies the retention rules to a file and returns (action, deadline). The action
+        is move for files with no rule or whose rule is due, delete for files whose rule
+        deletes them once due and hold, with the time the file is due, otherwise.
+
+        folder -- WatchedFolder the file is in, whose rules give its file group
+        """
+        if folder == None:
+            folder = self.config.folders[0]
+        file_type = self.get_file_type(file_name)
+        file_group = folder.rules.file_group(file_type)
+        rule = self.config.retention.rule_for(file_type, file_group, stat.st_size)
+        if rule == None:
+            return "move", None
+        deadline = stat.st_mtime + rule.min_age
+        if deadline > time.time():
+            return "hold", deadline
+        return rule.action, None
+
+    def expire_file(self, path) -> None:
+        """
+        Deletes a file whose retention rule ran out.
+        """
+        try:
+            self.fs.remove(path)
+        except FileNotFoundError:
+            return
+        print(f"Deleted expired file {os.path.basename(path)}")
+        self.metrics.count("files_expired")
+
+    def make_sharder(self):
+        """
+        Returns a Sharder for the current destination index or None if no destination is sharded.
+        """
+        if not self.config.sharding:
+            return None
+        return Sharder(self.config.sharding, self.dest_index, self.fs)
+
+    def make_folders(self, folders) -> int:
+        """
+        Creates the destination folders that do not exist yet along with their missing
+        parents, parents first, and returns how many were created. Folders already in the
+        destination index cost nothing, so a batch can create every shard up front and
+        file_move never has to check again.
+        """
+        created = 0
+        for folder in sorted(set(folders)):
+            if self.dest_index.folder_exists(folder):
+                continue
+            missing = [folder]
+            parent = os.path.dirname(folder)
+            while parent and parent != missing[-1] and not self.fs.exists(parent):
+                missing.append(parent)
+                parent = os.path.dirname(parent)
+            try:
+                for path in reversed(missing):
+                    self.fs.mkdir(path)
+                    created += 1
+            except FileExistsError:
+                # made by something else since it was checked so it is listed again
+                self.dest_index.forget(folder)
+                continue
+            self.dest_index.folder_created(folder)
+        return created
+
+    def tree_walk_of(self, entry):
+        """
+        Returns the tree walk of the folder an entry was found in or None if it was not walked.
+        """
+        if "folder" not in entry:
+            return None
+        return self.tree_walks.get(entry["folder"].path)
+
+    @staticmethod
+    def index_key(path) -> str:
+        """
+        Returns the scan index key of a file, its normalized absolute path, which stays
+        unique across watched folders even when they are on different drives.
+        """
+        return os.path.normcase(os.path.abspath(path))
+
+    def scan_queue_entries(self, expire=True):
+        """
+        Scans every watched folder and yields a move_queue entry for each file that should be moved.
+        Several folders are scanned at once and share the destination index and caches.
+        Files left in place are recorded in the scan index when incremental_scan is enabled.
+
+        expire -- deletes files whose retention rule ran out, otherwise they are only
+        collected in expired_files so plans and dry runs change nothing
+        """
+        self.dest_index = DestinationIndex(self.config.collision_policy, self.fs)
+        self.sharder = self.make_sharder()
+        scan_index = None
+        if self.config.incremental_scan:
+            scan_index = ScanIndex(self.config.scan_index_path, self.config.config_hash)
+        self.scan_index = scan_index
+        self.sniffer = None
+        if self.config.sniff_content:
+            self.sniffer = Sniffer(self.config.sniff_cache_path)
+        self.tree_walks = {}
+        self.delete_candidates = []
+        self.expired_files = []
+        if len(self.config.folders) == 1:
+            yield from self.scan_folder(self.config.folders[0], scan_index, expire)
+        else:
+            yield from self.scan_folders(self.config.folders, scan_index, expire)
+        if scan_index:
+            scan_index.save()
+        if self.sniffer:
+            self.sniffer.save()
+
+    def scan_folders(self, folders, scan_index, expire=True):
+        """
+        Scans each folder in its own thread and yields their entries as they are found.
+        """
+        found = queue.Queue(self.config.max_in_flight)
+
+        def scan(folder):
+            try:
+                for entry in self.scan_folder(folder, scan_index, expire):
+                    found.put(entry)
+                found.put(None)
+            except BaseException as error:
+                found.put(error)
+
+        for folder in folders:
+            threading.Thread(target=scan, args=(folder,), daemon=True).start()
+        finished = 0
+        while finished < len(folders):
+            entry = found.get()
+            if entry == None:
+                finished += 1
+            elif isinstance(entry, BaseException):
+                raise entry
+            else:
+                yield entry
+
+    def scan_folder(self, folder, scan_index, expire=True):
+        """
+        Scans a single WatchedFolder and yields a move_queue entry for each file that should be moved.
+        With recursive enabled, subfolders are walked in the same pass and destination folders are left alone.
+        """
+        if folder.recursive:
+            tree_walk = TreeWalk(folder.path, self.config.all_destinations(), self.fs)
+            self.tree_walks[folder.path] = tree_walk
+            watched_files = tree_walk.files()
+        else:
+            tree_walk = None
+            watched_files = self.fs.scandir(folder.path)
+        for file in watched_files:
+            if self.config.retention and not file.name.startswith(".") and file.is_file():
+                stat = file.stat()
+                action, deadline = self.check_retention(file.name, stat, folder)
+                if action == "hold":
+                    # not remembered in the scan index so it is checked again next run
+                    self.metrics.count("files_held")
+                    continue
+                if action == "delete":
+                    if expire:
+                        self.expire_file(file.path)
+                    else:
+                        self.expired_files.append(
+                            QueueEntry(file.path, stat.st_size, folder=folder)
+                        )
+                    if tree_walk:
+                        tree_walk.claim(file.path)
+                    continue
+            file_type = self.get_file_type(file.name)
+            if file_type in self.config.delete_def and self.config.ask_to_delete:
+                if file.is_file():
+                    # deletions are reviewed together once the scan is done
+                    self.delete_candidates.append(
+                        QueueEntry(file.path, file.stat().st_size, folder=folder)
+                    )
+                    continue
+            if not file.name.startswith(".") and file.is_file():
+                self.metrics.count("files_scanned")
+                stat = file.stat()
+                index_key = self.index_key(file.path)
+                # skips files left in place by an earlier scan that have not changed
+                if scan_index and scan_index.is_known(index_key, stat):
+                    self.metrics.count("files_skipped_by_index")
+                    continue
+                dict = self.queue_entry(file.name, file.path, stat.st_size, stat, folder)
+                if dict == None and scan_index:
+                    scan_index.remember(index_key, stat)
+                if dict != None:
+                    self.metrics.count("files_queued")
+                    self.metrics.count("bytes_queued", dict["file_size"])
+                    if tree_walk:
+                        tree_walk.claim(file.path)
+                    yield dict
+
+    def review_deletions(self):
+        """
+        Decides what happens to all deletion candidates from the last scan at once using
+        the delete_policy. ask shows every candidate and asks a single question, delete
+        removes them and keep leaves them to be sorted like any other file.
+        Returns move_queue entries for the candidates that were kept.
+        """
+        candidates = self.delete_candidates
+        self.delete_candidates = []
+        if not candidates:
+            return []
+        policy = self.delete_policy
+        if policy == "ask":
+            total = self.convert_size(sum(entry["file_size"] for entry in candidates))
+            msg = f"\n> {len(candidates)} files can be deleted totaling to {total}."
+            self.console.print(msg, style="secondary")
+            for entry in candidates:
+                print(f'{entry["file_name"]} ({self.convert_size(entry["file_size"])})')
+            response = self.ask("\nDo you want to delete all of these files?\n")
+            policy = "delete" if response.lower() in ["yes", "y", "yeah"] else "keep"
+        if policy == "delete":
+            for entry in candidates:
+                try:
+                    self.fs.remove(entry["target"])
+                except FileNotFoundError:
+                    continue
+                tree_walk = self.tree_walk_of(entry)
+                if tree_walk:
+                    tree_walk.claim(entry["target"])
+            return []
+        kept = []
+        for candidate in candidates:
+            entry = self.queue_entry(
+                candidate["file_name"],
+                candidate["target"],
+                candidate["file_size"],
+                folder=candidate["folder"],
+            )
+            if entry != None:
+                tree_walk = self.tree_walk_of(entry)
+                if tree_walk:
+                    tree_walk.claim(entry["target"])
+                kept.append(entry)
+        return kept
+
+    def handle_duplicates(self, entries):
+        """
+        Finds entries whose content is already in their destination folder and applies
+        the duplicate_action to them. Returns the entries that should still be moved.
+        """
+        from utils.dedupe import Deduper
+
+        deduper = Deduper(self.config.hash_cache_path, self.config.hash_workers)
+        with self.metrics.phase("dedupe"):
+            duplicates = deduper.find(entries)
+        self.metrics.count("files_hashed", deduper.files_hashed)
+        if not duplicates:
+            return entries
+        action = self.config.duplicate_action
+        if self.get_organize_mode() != "move" and action in ["delete", "hardlink"]:
+            # the source is the copy the user keeps in organize mode so it is only skipped
+            action = "skip"
+        duplicate_size = self.convert_size(sum(entry["file_size"] for entry, path in duplicates))
+        msg = f"> {len(duplicates)} duplicate files found totaling to {duplicate_size}."
+        self.console.print(msg, style="secondary")
+        self.metrics.count("duplicates_found", len(duplicates))
+        removed = set()
+        for entry, existing_path in duplicates:
+            print(f'{entry["file_name"]} is a copy of {existing_path}')
+            if action == "hardlink":
+                # moved by linking to the existing copy instead of transferring
+                entry["duplicate_of"] = existing_path
+                continue
+            if action == "delete":
+                try:
+                    self.fs.remove(entry["target"])
+                except FileNotFoundError:
+                    pass
+            elif self.tree_walk_of(entry):
+                # skipped files stay so their subfolder is not pruned
+                self.tree_walk_of(entry).release(entry["target"])
+            removed.add(id(entry))
+        return [entry for entry in entries if id(entry) not in removed]
+
     def setup_queue(self):
         """
         Sets up queue of files to be moved later.
         """
-        print(f"\nChecking for new files in {self.config.watched_folder}")
-        watched_files = os.scandir(self.config.watched_folder)
+        print(f"\nChecking for new files in {', '.join(self.config.folder_paths())}")
         self.move_queue = []
         self.queue_size = 0
         queue_length = 0
         large_files = 0
-        for file in watched_files:
-            file_type = self.get_file_type(file.name)
-            if file_type in self.config.delete_def and self.config.ask_to_delete:
-                response = input(f"\nDo you want to delete {file.name}?\n")
-                if response.lower() in ["yes", "y", "yeah"]:
-                    os.remove(file.path)
-                    continue
-            if not file.name.startswith(".") and file.is_file():
-                destination = self.set_destination(file.name)
-                if destination != None:
-                    file_size = os.path.getsize(file.path)
-                    dict = {
-                        "file_name": file.name,
-                        "file_size": file_size,
-                        "target": file.path,
-                        "destination": destination,
-                    }
-                    if file_size > 1e9:
-                        large_files += 1
-                    self.move_queue.append(dict)
-                    queue_length += 1
-                    self.queue_size += file_size
+        entries = list(self.scan_queue_entries())
+        entries += self.review_deletions()
+        if self.config.duplicate_action != "off":
+            entries = self.handle_duplicates(entries)
+        for dict in entries:
+            file_size = dict["file_size"]
+            if file_size > 1e9:
+                large_files += 1
+            self.move_queue.append(dict)
+            queue_length += 1
+            self.queue_size += file_size
         self.move_queue = sorted(self.move_queue, key=lambda i: i["file_size"])
+        held = self.metrics.counters.get("files_held", 0)
+        if held:
+            msg = f"> {held} files are held by retention rules until they are old enough."
+            self.console.print(msg, style="secondary")
         if len(self.move_queue) == 0:
             msg = f"> No new files found."
             self.console.print(msg, style="secondary")
-            self.delete_empty_folders(self.config.watched_folder)
-            input("\nPress Enter to close\n")
+            self.clean_empty_folders()
+            self.write_metrics()
+            self.ask("\nPress Enter to close\n")
             exit()
         elif queue_length == 1:
             is_files = "file"
@@ -163,94 +537,303 @@ class Cleaner(Utils):
 
     def file_rename(self, destination, target) -> str:
         """
-        Runs through file_rename_presets and replaces the set strings with the new strings and then returns it.
+        Applies every file_rename preset in a single pass using the renamer compiled
+        during config setup and returns the new path.
+        The original name is kept if renaming would leave nothing before the file type.
+        Collisions are handled by the destination index when the file is moved.
         """
-        file_name = os.path.basename(target)
-        for string, replacement in self.config.file_rename_presets.items():
-            pattern = re.compile(re.escape(string), re.IGNORECASE)
-            file_name = pattern.sub(replacement, file_name)
-            new_path = os.path.join(destination, file_name)
-            if os.path.exists(new_path) or file_name[0] == ".":
-                return os.path.join(destination, target)
-        return new_path
+        renamer = self.config.renamer
+        mtime = self.fs.stat(target).st_mtime if renamer.uses_mtime else None
+        file_name = renamer.rename(os.path.basename(target), mtime)
+        return os.path.join(destination, file_name)
 
-    def file_move(self, target: str, destination: str) -> None:
+    def file_move(
+        self,
+        target: str,
+        destination: str,
+        new_name=None,
+        duplicate_of=None,
+        rename=None,
+        on_chunk=None,
+        file_size=None,
+        mode="move",
+    ) -> str:
         """
         Moves Target file to Destination after making the destination directory if it does not exist.
         It will also leave the file where it is if it already exists at the destination.
+        Safe to call from several move workers at once. Returns the transfer method used.
 
         Keyword arguments:
 
         target -- file to move
 
         destination -- destination of target file
+
+        new_name -- name already chosen for the file, such as one from a plan
+
+        duplicate_of -- existing file with the same content to hard link instead of copying
+
+        rename -- overrides the rename setting, such as for a watched folder with its own
+
+        on_chunk -- called with the byte count of each chunk when the file has to be copied
+
+        file_size -- size of the file for the manifest
+
+        mode -- move, or reflink or hardlink to place the file while leaving the target where it is
         """
-        if os.path.isdir(destination) is False:  # checks if destination directory exist
-            os.mkdir(destination)  # makes directory if it does not exist
-        if self.config.rename:
-            destination = self.file_rename(destination, target)
-        shutil.move(target, destination)
+        if rename == None:
+            rename = self.config.rename
+        with self.move_lock:
+            # makes the destination folder if it does not exist
+            self.make_folders([destination])
+            new_path = os.path.join(destination, os.path.basename(target))
+            if new_name != None:
+                new_path = os.path.join(destination, new_name)
+            elif rename:
+                new_path = self.file_rename(destination, target)
+            # in organize mode a copy placed by an earlier run is not placed again
+            file_name, overwrite = self.dest_index.resolve(
+                destination, os.path.basename(new_path), target, keep_source=mode != "move"
+            )
+            if file_name == None:
+                if self.manifest:
+                    skipped_path = os.path.join(destination, os.path.basename(new_path))
+                    self.manifest.record(target, skipped_path, file_size, "skip")
+                return "skip"
+            # reserves the name so another worker can not move onto it
+            self.dest_index.add(destination, file_name)
+            limiter = self.limiter_for(destination)
+        new_path = os.path.join(destination, file_name)
+        keep_source = mode != "move"
+        move_id = None
+        if self.journal:
+            move_id = self.journal.plan_move(target, new_path, overwrite, keep_source)
+        try:
+            method = None
+            if keep_source:
+                method = self.fs.link(
+                    target,
+                    new_path,
+                    mode,
+                    self.cancel_event,
+                    overwrite=overwrite,
+                    limiter=limiter,
+                    on_chunk=on_chunk,
+                )
+            elif duplicate_of != None and not overwrite:
+                from utils.dedupe import link_duplicate
+
+                try:
+                    method = link_duplicate(duplicate_of, new_path, target)
+                except OSError:
+                    # different filesystems so the file is moved normally
+                    pass
+            if method == None:
+                method = self.fs.move(
+                    target,
+                    new_path,
+                    self.cancel_event,
+                    overwrite=overwrite,
+                    limiter=limiter,
+                    on_chunk=on_chunk,
+                )
+        except BaseException:
+            self.dest_index.discard(destination, file_name)
+            if move_id:
+                self.journal.fail_move(move_id)
+            raise
+        if move_id:
+            self.journal.finish_move(move_id, method)
+        if self.manifest:
+            self.manifest.record(target, new_path, file_size, method)
+        return method
+
+    def limiter_for(self, destination):
+        """
+        Returns the RateLimiter shared by every copy to the device `destination` is on
+        or None if the device has no bandwidth limit. Called with the move_lock held.
+        """
+        if destination not in self.dest_limiters:
+            device = self.fs.device_id(destination)
+            if device not in self.limiters:
+                limit = self.config.bandwidth_limit
+                for path, device_limit in self.config.device_bandwidth_limits.items():
+                    if self.fs.device_id(path) == device:
+                        limit = device_limit
+                self.limiters[device] = None
+                if limit:
+                    from utils.throttle import RateLimiter
+
+                    self.limiters[device] = RateLimiter(limit)
+            self.dest_limiters[destination] = self.limiters[device]
+        return self.dest_limiters[destination]
+
+    def lower_priority(self) -> None:
+        """
+        Switches to low disk and CPU priority if asked for by the config or command line.
+        """
+        if self.low_io_priority or self.config.low_io_priority:
+            from utils.throttle import set_low_io_priority
+
+            if not set_low_io_priority():
+                msg = "> Low priority is not supported on this platform."
+                self.console.print(msg, style="warning")
+
+    def get_organize_mode(self) -> str:
+        return self.organize_mode or self.config.organize_mode
+
+    def move_entry(self, entry) -> None:
+        """
+        Moves a single move_queue entry, reporting its progress and how long it took.
+        In organize mode the file is placed instead and remembered in the scan index,
+        since it stays in the watched folder.
+        """
+        mode = self.get_organize_mode()
+        start = time.perf_counter()
+        progress = self.progress
+        on_chunk = None
+        copied = [0]
+        if progress:
+
+            def on_chunk(count):
+                copied[0] += count
+                progress.add_bytes(count, entry["file_name"])
+
+        method = self.file_move(
+            entry["target"],
+            entry["destination"],
+            entry.get("new_name"),
+            entry.get("duplicate_of"),
+            entry["folder"].rename if "folder" in entry else None,
+            on_chunk,
+            entry["file_size"],
+            mode,
+        )
+        if mode != "move" and self.scan_index:
+            self.scan_index.remember(self.index_key(entry["target"]), self.fs.stat(entry["target"]))
+        self.metrics.record_move(
+            entry["destination"], entry["file_size"], start, time.perf_counter(), method
+        )
+        if progress:
+            progress.file_done(entry["file_size"] - copied[0], entry["file_name"])
+
+    def start_progress(self, bar, bytes_total=None, files_total=None):
+        """
+        Creates the Progress for a run that reports to the bar and the progress callbacks.
+        """
+        callbacks = list(self.progress_callbacks)
+        if bar is not None:
+            callbacks.append(bar_callback(bar))
+        self.progress = Progress(bytes_total, files_total, callbacks)
+        return self.progress
 
     def move_file_queue(self) -> None:
         """
         Goes through the list of dictionarys in the move_queue to send all files to their correct destinations.
+        Moves run concurrently with at most `workers_per_device` moves per destination filesystem.
         It will employ a progress bar if enabled in the config.
         """
+        self.cancel_event.clear()
+        # every destination and shard folder is created before the first move
+        self.make_folders(entry["destination"] for entry in self.move_queue)
+        engine = MoveEngine(
+            self.move_entry,
+            self.config.workers_per_device,
+            self.cancel_event,
+            self.config.large_file_size,
+            self.fs.device_id,
+        )
+        bar = self.progress_bar(total=self.queue_size, desc="> Moving Files")
+        # the bar and callbacks are updated at a fixed rate with bytes from inside copies
+        progress = self.start_progress(bar, self.queue_size, len(self.move_queue))
+        methods_before = dict(self.metrics.methods)
         try:
-            if self.config.progress_bar:
-                # uses progress bar
-                # TODO set to use tqdm.concurrent
-                with tqdm(
-                    total=self.queue_size,
-                    ascii=self.config.ascii,
-                    unit="byte",
-                    unit_scale=1,
-                    dynamic_ncols=1,
-                ) as bar:
-                    bar.set_description(desc=f"> Moving Files", refresh=1)
-                    for entry in self.move_queue:
-                        self.file_move(entry["target"], entry["destination"])
-                        bar.update(entry["file_size"])
+            try:
+                errors = engine.run(self.move_queue)
+            finally:
+                progress.close()
+                self.progress = None
+                if bar is not None:
                     bar.close()
-            else:
-                # does not use progress bar
-                for entry in self.move_queue:
-                    self.file_move(entry["target"], entry["destination"])
+            for entry, error in errors:
+                msg = f"> Failed to move {entry['file_name']}: {error}"
+                self.console.print(msg, style="warning")
             print("> All files have been moved")
+            self.report_organized(methods_before)
         except KeyboardInterrupt:
-            # TODO delete partial copy if in progress
-            path = os.path.join(entry["destination"], os.path.basename(entry["target"]))
-            print(path)
-            if os.path.exists(path):
-                print("Removed partial copy.")
-                # os.remove(path)
+            # renames finish and chunked copies remove their partial file
+            cancelled = [e for e, error in engine.errors if type(error) == TransferCancelled]
+            for entry in cancelled:
+                print(f"Removed partial copy of {entry['file_name']}.")
             print("Cancelled folder clean")
             return
-        except ModuleNotFoundError:
-            print(
-                "Please disable progress bar in config or install the module via Pip."
-            )
 
-    def delete_empty_folders(self, directory) -> None:
+    def stream_queue(self) -> None:
         """
-        Deletes empty folders in the watched_folder entered as an argument.
+        Moves files while the watched_folder is still being scanned instead of building
+        and sorting the whole move_queue first. Only a bounded number of files are held
+        in memory at once and totals are reported as they accumulate.
+        """
+        print(f"\nStreaming new files from {', '.join(self.config.folder_paths())}")
+        print("Use Ctrl C if you need to cancel")
+        self.move_queue = []
+        self.queue_size = 0
+        self.cancel_event.clear()
+        engine = MoveEngine(
+            self.move_entry,
+            self.config.workers_per_device,
+            self.cancel_event,
+            self.config.large_file_size,
+            self.fs.device_id,
+        )
+        bar = self.progress_bar(desc="> Moving Files")
+        # totals are not known up front so only what was moved is reported
+        progress = self.start_progress(bar)
+        methods_before = dict(self.metrics.methods)
+        try:
+            errors = engine.run_stream(self.scan_queue_entries(), None, self.config.max_in_flight)
+            # kept deletion candidates are moved once they have been reviewed
+            errors += engine.run(self.review_deletions())
+            for entry, error in errors:
+                msg = f"> Failed to move {entry['file_name']}: {error}"
+                self.console.print(msg, style="warning")
+        except KeyboardInterrupt:
+            print("Cancelled folder clean")
+        finally:
+            progress.close()
+            self.progress = None
+            if bar is not None:
+                bar.close()
+        self.queue_size = progress.bytes_done
+        converted_size = self.convert_size(self.queue_size)
+        msg = f"> Moved {progress.files_done} files totaling to {converted_size}."
+        self.console.print(msg, style="secondary")
+        self.report_organized(methods_before)
+
+    def report_organized(self, methods_before) -> None:
+        """
+        After an organize run, saves the scan index with the files that were placed and
+        prints how many files each method placed.
+
+        methods_before -- copy of the metrics method counts from before the run
+        """
+        if self.get_organize_mode() == "move":
+            return
+        if self.scan_index:
+            self.scan_index.save()
+        counts = []
+        for method, count in sorted(self.metrics.methods.items()):
+            count -= methods_before.get(method, 0)
+            if count:
+                counts.append(f"{count} {method}")
+        if counts:
+            msg = f"> Organized files by {', '.join(counts)}."
+            self.console.print(msg, style="secondary")
+
+    def print_deleted_folders(self, delete_total) -> None:
+        """
+        Prints how many empty folders were deleted.
         """
-        delete_total = 0  # init var for total empty folders deleted
-        print(f"\nChecking for empty directories.")
-        for file in os.scandir(directory):
-            # checks if file is a folder instead of a file
-            folder_exists = os.path.exists(file.path)
-            is_folder = not os.path.isfile(file.path)
-            if folder_exists and is_folder:
-                # detects if folder is empty
-                if len(os.listdir(file.path)) == 0:
-                    try:
-                        os.rmdir(file.path)
-                    # error check in case of unseen circumstance
-                    except OSError:
-                        print(f"Failed to delete {file.name}\nIt is not empty.")
-                    delete_total += 1
-        # prints info if empty folders were deleted
         if delete_total == 1:
             msg = "> Deleted 1 empty folder."
             self.console.print(msg, style="secondary")
@@ -261,40 +844,603 @@ class Cleaner(Utils):
             msg = f"> No empty folders were found."
             self.console.print(msg, style="secondary")
 
-    def completion_sound(self) -> None:
+    def delete_empty_folders(self, directory) -> None:
         """
-        Plays a completion sound.
+        Deletes empty folders in the watched_folder entered as an argument.
         """
-        # TODO delete or use
-        winsound.PlaySound("Exclamation", winsound.SND_ALIAS)
+        delete_total = 0  # init var for total empty folders deleted
+        print(f"\nChecking for empty directories.")
+        for file in self.fs.scandir(directory):
+            # uses the type info scandir already has instead of extra stat calls
+            if file.is_dir(follow_symlinks=False):
+                # rmdir only succeeds on empty folders so no listdir is needed
+                try:
+                    self.fs.rmdir(file.path)
+                except OSError:
+                    continue
+                delete_total += 1
+        self.print_deleted_folders(delete_total)
 
-    def run(self):
+    def clean_empty_folders(self) -> None:
         """
-        Runs main script process.
+        Removes empty folders left after the move. A recursive scan prunes the whole
+        tree bottom-up from what it already saw, otherwise only the top level is checked.
         """
-        self.console.print("Auto Folder Cleaner", style="primary")
+        for folder in self.config.folders:
+            tree_walk = self.tree_walks.get(folder.path)
+            if tree_walk:
+                print(f"\nChecking for empty directories.")
+                self.print_deleted_folders(tree_walk.prune())
+            else:
+                self.delete_empty_folders(folder.path)
+
+    def watch(self):
+        """
+        Runs as a daemon that keeps the compiled config in memory and only moves
+        files in the watched folders that were created or changed. Files are held
+        until they stop changing for the settle window so downloads finish first.
+        Every folder is watched from its own thread and their moves share one engine.
+        Files held by retention rules wait in a deadline heap and the loop sleeps until
+        the earliest one is due instead of checking them again.
+        """
+        from utils.watcher import get_watcher, Settler
+
+        self.console.print("Auto Folder Cleaner | Watch Mode", style="primary")
         self.config.setup()
+        self.lower_priority()
         self.destination_check()
-        self.setup_queue()
+        folders = {folder.path: folder for folder in self.config.folders}
+        settlers = {
+            path: Settler(path, self.config.settle_seconds, self.config.partial_suffixes)
+            for path in folders
+        }
+        watchers = [get_watcher(path, self.config.watch_interval) for path in folders]
+        # (folder path, changed names) from every watcher thread
+        events = queue.Queue()
+
+        def read_events(path, watcher):
+            try:
+                while True:
+                    changed = watcher.read()
+                    if changed is None or changed:
+                        events.put((path, changed))
+            except (OSError, ValueError):
+                # the watcher was closed
+                return
+
+        for path, watcher in zip(folders, watchers):
+            threading.Thread(target=read_events, args=(path, watcher), daemon=True).start()
+        # headers are only read again for files that changed so the cache stays in memory
+        self.sniffer = Sniffer() if self.config.sniff_content else None
+        # (folder path, name) of files held by retention rules keyed by when they are due
+        deadlines = DeadlineHeap()
+        # files already in the folders are handled like new ones
+        for path, settler in settlers.items():
+            settler.add(os.listdir(path))
+        print(f"\nWatching {', '.join(folders)} | Use Ctrl C to stop")
+        try:
+            with self.manifest_context(append=True):
+                while True:
+                    # sleeps until the next settle check or the earliest retention deadline
+                    timeouts = []
+                    if any(settler.pending for settler in settlers.values()):
+                        timeouts.append(self.config.watch_interval)
+                    next_deadline = deadlines.next_deadline()
+                    if next_deadline != None:
+                        timeouts.append(max(0, next_deadline - time.time()))
+                    try:
+                        batch = [events.get(timeout=min(timeouts) if timeouts else None)]
+                        while not events.empty():
+                            batch.append(events.get())
+                    except queue.Empty:
+                        batch = []
+                    for path, changed in batch:
+                        if changed is None:
+                            # event queue overflowed so everything is checked again
+                            changed = os.listdir(path)
+                        settlers[path].add(changed)
+                    # destinations are listed again each batch in case they changed
+                    self.dest_index = DestinationIndex(self.config.collision_policy, self.fs)
+                    self.sharder = self.make_sharder()
+                    self.move_queue = []
+                    self.queue_size = 0
+                    ready = deadlines.pop_due(time.time())
+                    for path, settler in settlers.items():
+                        ready += [(path, file_name) for file_name in settler.ready()]
+                    for path, file_name in ready:
+                        file_path = os.path.join(path, file_name)
+                        try:
+                            stat = os.stat(file_path)
+                        except FileNotFoundError:
+                            continue
+                        action, deadline = self.check_retention(
+                            file_name, stat, folders[path]
+                        )
+                        if action == "hold":
+                            deadlines.push(deadline, (path, file_name))
+                            continue
+                        if action == "delete":
+                            self.expire_file(file_path)
+                            continue
+                        entry = self.queue_entry(
+                            file_name, file_path, stat.st_size, stat, folders[path]
+                        )
+                        if entry != None:
+                            self.move_queue.append(entry)
+                            self.queue_size += entry["file_size"]
+                    if self.sniffer:
+                        self.sniffer.save()
+                    if self.move_queue:
+                        for entry in self.move_queue:
+                            print(f'> {entry["file_name"]} -> {entry["destination"]}')
+                        # each batch is its own journaled run
+                        with self.metrics.phase("move"), self.journal_context():
+                            self.move_file_queue()
+                        if self.manifest:
+                            self.manifest.flush()
+                        self.write_metrics()
+        except KeyboardInterrupt:
+            print("\nStopped watching")
+        finally:
+            for watcher in watchers:
+                watcher.close()
+
+    def print_plan_totals(self, moves, deletions) -> None:
+        """
+        Prints how many files a plan moves and deletes and how much data that is.
+        """
+        destinations = {}
+        for entry in moves:
+            count, size = destinations.get(entry["destination"], (0, 0))
+            destinations[entry["destination"]] = (count + 1, size + entry["file_size"])
+        move_size = self.convert_size(sum(entry["file_size"] for entry in moves))
+        msg = f"> {len(moves)} files to move totaling to {move_size}."
+        self.console.print(msg, style="secondary")
+        for destination, (count, size) in sorted(destinations.items()):
+            print(f"  {destination}: {count} files, {self.convert_size(size)}")
+        delete_size = self.convert_size(sum(entry["file_size"] for entry in deletions))
+        msg = f"> {len(deletions)} files to delete totaling to {delete_size}."
+        self.console.print(msg, style="secondary")
+
+    def make_plan(self, path, dry_run=False) -> None:
+        """
+        Scans and classifies the watched folders in one batch without asking anything
+        and writes the moves, renames and deletion candidates to a plan file.
+
+        Keyword arguments:
+
+        path -- plan file to write
+
+        dry_run -- only prints the plan totals
+        """
+        self.console.print("Auto Folder Cleaner | Plan", style="primary")
+        self.config.setup()
+        self.destination_check(interactive=False)
+        print(f"\nChecking for new files in {', '.join(self.config.folder_paths())}")
+        # expired files are planned as deletions instead of being deleted by the scan
+        moves = sorted(self.scan_queue_entries(expire=False), key=lambda i: i["file_size"])
+        deletions = self.delete_candidates + self.expired_files
+        for entry in moves + deletions:
+            entry["mtime"] = self.fs.stat(entry["target"]).st_mtime_ns
+        for entry in moves:
+            new_path = entry["target"]
+            if entry["folder"].rename:
+                new_path = self.file_rename(entry["destination"], entry["target"])
+            entry["new_name"] = os.path.basename(new_path)
+        self.print_plan_totals(moves, deletions)
+        if not dry_run:
+            write_plan(
+                path,
+                self.config.config_hash,
+                self.config.watched_folder,
+                moves,
+                deletions,
+                self.config.folder_paths(),
+            )
+            print(f"\nPlan saved to {path}")
+
+    def apply_plan(self, path, dry_run=False) -> None:
+        """
+        Executes a plan file without any prompts. Files that changed or disappeared
+        since the plan was made are skipped. Deletion candidates follow the delete_policy,
+        with ask treated as keep since nothing is asked.
+
+        Keyword arguments:
+
+        path -- plan file to apply
+
+        dry_run -- only prints the plan totals
+        """
+        self.console.print("Auto Folder Cleaner | Apply", style="primary")
+        self.config.setup()
+        self.lower_priority()
+        plan = read_plan(path)
+        if plan["config_hash"] != self.config.config_hash:
+            msg = "> The config changed since this plan was made."
+            self.console.print(msg, style="warning")
+        deletions = plan["deletions"] if self.delete_policy == "delete" else []
+        self.print_plan_totals(plan["moves"], deletions)
+        if dry_run:
+            return
+        self.move_queue = [entry for entry in plan["moves"] if unchanged(entry, self.fs.stat)]
+        skipped = len(plan["moves"]) - len(self.move_queue)
+        if skipped:
+            msg = f"> Skipping {skipped} files that changed since the plan was made."
+            self.console.print(msg, style="warning")
+        self.queue_size = sum(entry["file_size"] for entry in self.move_queue)
+        self.dest_index = DestinationIndex(self.config.collision_policy, self.fs)
+        for entry in deletions:
+            if unchanged(entry, self.fs.stat):
+                self.fs.remove(entry["target"])
         print("\nStarting Folder Clean | Use Ctrl C if you need to cancel")
-        self.move_file_queue()
+        with self.journal_context(), self.manifest_context():
+            self.move_file_queue()
         if self.config.settings["delete_empty_folders"]:
-            self.delete_empty_folders(self.config.watched_folder)
+            for folder in plan["watched_folders"]:
+                self.delete_empty_folders(folder)
         print("\nFolder Clean Complete")
-        winsound.PlaySound("Exclamation", winsound.SND_ALIAS)
-        if len(self.move_queue) > 5:
-            response = input(
+
+    @contextlib.contextmanager
+    def journal_context(self):
+        """
+        Journals every move made inside the with block if journal is enabled.
+        Runs that were cut off are recovered first and the journal is compacted after.
+        Simulated runs are not journaled since the journal and its recovery use the real disk.
+        """
+        if not self.config.journal or self.fs.simulated:
+            yield
+            return
+        path = self.config.journal_path
+        runs = read_runs(path)
+        self.journal = Journal(path)
+        self.journal.open()
+        try:
+            self.recover_runs(runs)
+            yield
+        finally:
+            self.journal.close()
+            self.journal = None
+            compact(path, read_runs(path))
+
+    @contextlib.contextmanager
+    def manifest_context(self, append=False):
+        """
+        Writes every file moved inside the with block to the manifest if one is set.
+
+        append -- adds to the manifest instead of replacing it, for watch mode batches
+        """
+        path = self.manifest_path or self.config.manifest_path
+        if not path:
+            yield
+            return
+        self.manifest = Manifest(path, append)
+        try:
+            yield
+        finally:
+            self.manifest.close()
+            self.manifest_rows = self.manifest.rows
+            self.manifest_moved = self.manifest.rows - self.manifest.skipped
+            self.manifest = None
+
+    def print_manifest(self, moved) -> None:
+        """
+        Prints the files a run moved, asking first if there are more than five. Read back
+        from the manifest file when there is one so the run does not keep them in memory.
+
+        moved -- number of files moved
+        """
+        if moved > 5:
+            response = self.ask(
                 "\nDo you want to see the file Manifist?\nIf not press enter to close.\n"
             )
             if response.lower() not in ["yes", "y", "yeah"]:
                 exit()
         print("\nFile Manifest")
-        for entry in self.move_queue:
-            print(f'\n> Name: {entry["file_name"]}\n  Dest: {entry["destination"]}')
+        path = self.manifest_path or self.config.manifest_path
+        if path:
+            skipped = 0
+            for row in read_manifest(path):
+                if row["method"] == "skip":
+                    # left in place so they are counted instead of listed
+                    skipped += 1
+                    continue
+                name = os.path.basename(row["destination"])
+                destination = os.path.dirname(row["destination"])
+                print(f"\n> Name: {name}\n  Dest: {destination}")
+            if skipped:
+                msg = f"\n> {skipped} files were skipped since their name was taken."
+                self.console.print(msg, style="secondary")
+        else:
+            for entry in self.move_queue:
+                print(f'\n> Name: {entry["file_name"]}\n  Dest: {entry["destination"]}')
+
+    def recover_runs(self, runs) -> None:
+        """
+        Finishes or rolls back the moves of journaled runs that never ended.
+        """
+        for run_id, run in runs.items():
+            if run["ended"]:
+                continue
+            counts = {"done": 0, "rolled_back": 0, "missing": 0}
+            for move in run["moves"].values():
+                if move["state"] != "plan":
+                    continue
+                result = recover_move(move)
+                counts[result] += 1
+                op = "done" if result == "done" else "failed"
+                self.journal.append(
+                    {"op": op, "id": move["id"], "method": "recovered", "run": run_id}
+                )
+            self.journal.append({"op": "recovered", "run": run_id}, wait=True)
+            msg = (
+                f"> Recovered interrupted run {run_id}: {counts['done']} moves finished, "
+                f"{counts['rolled_back']} rolled back and {counts['missing']} missing."
+            )
+            self.console.print(msg, style="warning")
+
+    def undo(self, run_id=None) -> None:
+        """
+        Moves every file from a journaled run back to where it came from, newest move first.
+        Only the journal is read so no destination has to be searched.
+
+        run_id -- run to undo, defaults to the last run that was not undone
+        """
+        self.console.print("Auto Folder Cleaner | Undo", style="primary")
+        self.config.setup()
+        runs = read_runs(self.config.journal_path)
+        if run_id == None:
+            for candidate, run in reversed(runs.items()):
+                moved = [m for m in run["moves"].values() if m["state"] == "done"]
+                if moved and not run["undone"] and not run["undo_of"]:
+                    run_id = candidate
+                    break
+        if run_id not in runs or runs[run_id]["undone"]:
+            self.console.print("> No run to undo was found.", style="secondary")
+            return
+        moves = [m for m in runs[run_id]["moves"].values() if m["state"] == "done"]
+        self.dest_index = DestinationIndex("skip")
+        with self.journal_context():
+            if self.journal:
+                self.journal.append({"op": "undo", "target": run_id}, wait=True)
+            restored = 0
+            removed = 0
+            for move in reversed(moves):
+                if move.get("keep"):
+                    # organized files never left so the placed copy is removed
+                    if os.path.exists(move["dst"]) and os.path.exists(move["src"]):
+                        os.remove(move["dst"])
+                        removed += 1
+                    else:
+                        print(f'Skipped {move["dst"]}')
+                    continue
+                if not os.path.exists(move["dst"]) or os.path.exists(move["src"]):
+                    print(f'Skipped {move["dst"]}')
+                    continue
+                folder = os.path.dirname(move["src"])
+                os.makedirs(folder, exist_ok=True)
+                self.file_move(move["dst"], folder, os.path.basename(move["src"]))
+                restored += 1
+        if removed:
+            msg = f"> Removed {removed} of {len(moves)} organized files from run {run_id}."
+            self.console.print(msg, style="secondary")
+        if restored or not removed:
+            msg = f"> Moved {restored} of {len(moves)} files from run {run_id} back."
+            self.console.print(msg, style="secondary")
+
+    def reshard(self, destination=None, dry_run=False) -> None:
+        """
+        Moves the files sitting directly in sharded destination folders into the subfolders
+        their destination_sharding rule gives them, for folders that grew large before
+        the rule was added. Files keep their names and subfolders are created up front.
+
+        Keyword arguments:
+
+        destination -- folder to reshard, defaults to every destination with a rule
+
+        dry_run -- only prints the totals
+        """
+        self.console.print("Auto Folder Cleaner | Reshard", style="primary")
+        self.config.setup()
+        # files in a destination are always moved into its subfolders
+        self.organize_mode = "move"
+        self.lower_priority()
+        folders = self.config.sharding.folders()
+        if destination != None:
+            if self.config.sharding.rule_for(destination) == None:
+                msg = f"> {destination} has no destination_sharding rule."
+                self.console.print(msg, style="warning")
+                return
+            folders = [destination]
+        self.dest_index = DestinationIndex(self.config.collision_policy, self.fs)
+        self.sharder = self.make_sharder()
+        self.move_queue = []
+        for folder in folders:
+            try:
+                files = self.fs.scandir(folder)
+            except FileNotFoundError:
+                continue
+            with files:
+                for file in files:
+                    if file.name.startswith(".") or not file.is_file(follow_symlinks=False):
+                        continue
+                    stat = file.stat()
+                    shard = self.sharder.shard(folder, file.name, stat)
+                    entry = QueueEntry(
+                        file.path, stat.st_size, self.destinations.intern(shard), new_name=file.name
+                    )
+                    self.move_queue.append(entry)
+        self.queue_size = sum(entry.file_size for entry in self.move_queue)
+        self.print_plan_totals(self.move_queue, [])
+        if dry_run or not self.move_queue:
+            return
+        print("\nStarting Reshard | Use Ctrl C if you need to cancel")
+        with self.journal_context(), self.manifest_context():
+            self.move_file_queue()
+
+    def metrics_context(self):
+        """
+        Counts filesystem calls while the run is in progress if a metrics report was asked for.
+        A simulated filesystem counts its own calls exactly.
+        """
+        if self.fs.simulated:
+            return contextlib.nullcontext()
+        if self.metrics_path or self.prometheus_path:
+            return self.metrics.count_syscalls()
+        return contextlib.nullcontext()
+
+    def write_metrics(self) -> None:
+        """
+        Writes the metrics report to the JSON and Prometheus files that were asked for.
+        """
+        if self.fs.simulated:
+            self.metrics.syscalls = dict(self.fs.calls)
+        if self.metrics_path:
+            self.metrics.write_json(self.metrics_path)
+        if self.prometheus_path:
+            self.metrics.write_prometheus(self.prometheus_path)
+
+    def completion_sound(self) -> None:
+        """
+        Plays a completion sound if enabled and the platform has one (Windows only).
+        """
+        if not self.config.completion_sound:
+            return
+        try:
+            import winsound
+        except ImportError:
+            return
+        winsound.PlaySound("Exclamation", winsound.SND_ALIAS)
+
+    def run(self, stream=None):
+        """
+        Runs main script process.
+
+        stream -- overrides the streaming setting when set
+        """
+        self.console.print("Auto Folder Cleaner", style="primary")
+        with self.metrics_context():
+            with self.metrics.phase("config_load"):
+                self.config.setup()
+            self.lower_priority()
+            if stream != None:
+                self.config.streaming = stream
+            with self.metrics.phase("destination_check"):
+                self.destination_check()
+            with self.journal_context(), self.manifest_context():
+                if self.config.streaming:
+                    # scanning and moving overlap so they are timed together
+                    with self.metrics.phase("scan_and_move"):
+                        self.stream_queue()
+                else:
+                    # scan time includes the classify time
+                    with self.metrics.phase("scan"):
+                        self.setup_queue()
+                    print("\nStarting Folder Clean | Use Ctrl C if you need to cancel")
+                    with self.metrics.phase("move"):
+                        self.move_file_queue()
+            if self.config.settings["delete_empty_folders"]:
+                with self.metrics.phase("cleanup"):
+                    self.clean_empty_folders()
+        self.write_metrics()
+        print("\nFolder Clean Complete")
+        self.completion_sound()
+        if self.manifest_path or self.config.manifest_path:
+            self.print_manifest(self.manifest_moved)
+        elif self.config.streaming:
+            # streamed files are not kept in memory for a manifest
+            self.ask("\nPress enter to close.")
+            return
+        else:
+            self.print_manifest(len(self.move_queue))
         # TODO allow opening folders that files where moved to after prompt
-        input("\nPress enter to close.")
+        self.ask("\nPress enter to close.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Auto Folder Cleaner")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="run",
+        choices=["run", "watch", "plan", "apply", "undo", "reshard"],
+        help="run cleans the folder once, watch keeps cleaning it as files arrive, "
+        "plan saves what a run would do, apply carries out a saved plan, undo "
+        "moves the files of the last journaled run back and reshard moves files in "
+        "sharded destinations into their subfolders",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=None,
+        help="move files while scanning instead of sorting the whole queue first",
+    )
+    parser.add_argument(
+        "--plan",
+        default="plan.json",
+        help="plan file written by plan and read by apply",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the totals of what would be moved and deleted",
+    )
+    parser.add_argument(
+        "--delete-policy",
+        choices=["ask", "delete", "keep"],
+        default=None,
+        help="what to do with files matching delete_def, ask asks once for all of them",
+    )
+    parser.add_argument(
+        "--low-priority",
+        action="store_true",
+        help="use idle disk priority and a lower CPU priority so other programs go first",
+    )
+    parser.add_argument(
+        "--organize",
+        choices=["reflink", "hardlink"],
+        help="leave files in the watched folders and place a reflink or hard link at their "
+        "destination, copying only across drives",
+    )
+    parser.add_argument("--run", help="journaled run for undo, defaults to the last one")
+    parser.add_argument(
+        "--dest", help="destination for reshard, defaults to every sharded destination"
+    )
+    parser.add_argument(
+        "--manifest", help="write moved files to this .csv or .jsonl file as they move"
+    )
+    parser.add_argument("--metrics", help="write a JSON metrics report to this file")
+    parser.add_argument(
+        "--prometheus", help="write metrics to this Prometheus textfile collector file"
+    )
+    parser.add_argument("--profile", help="write cProfile stats for the run to this file")
+    args = parser.parse_args()
     App = Cleaner()
-    App.run()
+    App.metrics_path = args.metrics
+    App.prometheus_path = args.prometheus
+    if args.delete_policy:
+        App.delete_policy = args.delete_policy
+    App.low_io_priority = args.low_priority
+    App.manifest_path = args.manifest
+    App.organize_mode = args.organize
+    if args.profile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if args.command == "watch":
+            App.watch()
+        elif args.command == "plan" or (args.command == "run" and args.dry_run):
+            App.make_plan(args.plan, dry_run=args.dry_run)
+        elif args.command == "apply":
+            App.apply_plan(args.plan, dry_run=args.dry_run)
+        elif args.command == "undo":
+            App.undo(args.run)
+        elif args.command == "reshard":
+            App.reshard(args.dest, dry_run=args.dry_run)
+        else:
+            App.run(stream=args.stream)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
@@ -0,0 +1,233 @@
+"""
+Benchmarks the hot paths of the cleaner on a synthetic watched folder.
+
+Builds a folder of generated files with a mix of extensions from template_config.json,
+a rule set padded out with generated keywords and rename presets, then times
+set_destination, file_rename, setup_queue, move_file_queue and delete_empty_folders
+separately. Results are saved as JSON and can be compared against an earlier run.
+
+With --simulate the folders live in utils.filesystem.MemoryFileSystem instead of on
+disk, so millions of files can be run in seconds and every filesystem call is counted.
+
+Example:
+
+python test/benchmark.py --files 100000 --keywords 500 --output bench.json
+python test/benchmark.py --files 100000 --keywords 500 --compare bench.json
+python test/benchmark.py --files 1000000 --simulate --latency 0.00001
+"""
+import contextlib, argparse, tempfile, random, shutil, json, time, sys, os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from main import Cleaner
+from utils.filesystem import MemoryFileSystem
+
+
+def make_config(work_dir, keywords, presets, seed):
+    """
+    Writes a config based on template_config.json with destinations inside `work_dir`
+    and extra generated keywords and rename presets. Returns the config path.
+    """
+    rand = random.Random(seed)
+    with open(os.path.join(ROOT, "template_config.json")) as json_file:
+        data = json.load(json_file)
+    dest_root = os.path.join(work_dir, "sorted")
+    os.makedirs(dest_root)
+    data["settings"].update(
+        {
+            "watched_folder": os.path.join(work_dir, "watched"),
+            "ask_to_delete": False,
+            "progress_bar": False,
+            "incremental_scan": False,
+            "streaming": False,
+            "recursive": False,
+        }
+    )
+    for group in data["file_group_dest"]:
+        data["file_group_dest"][group] = os.path.join(dest_root, group)
+    for case in data["special_case_dest"]:
+        data["special_case_dest"][case] = os.path.join(dest_root, f"special{case}")
+    groups = list(data["file_type_groups"])
+    for keyword in list(data["keywords_dest"]):
+        data["keywords_dest"][keyword][1] = os.path.join(dest_root, keyword)
+    for i in range(keywords):
+        keyword = f"kw{i:05d}"
+        data["keywords_dest"][keyword] = [
+            [rand.choice(groups)],
+            os.path.join(dest_root, "keywords", keyword),
+        ]
+    os.makedirs(os.path.join(dest_root, "keywords"))
+    for i in range(presets):
+        data["file_rename"][f"preset{i:05d}"] = f"renamed{i:05d}"
+    path = os.path.join(work_dir, "config.json")
+    with open(path, "w") as json_file:
+        json.dump(data, json_file)
+    return path, data
+
+
+def make_names(data, count, keywords, seed):
+    """
+    Returns `count` unique file names with extensions from the config, some holding keywords.
+    """
+    rand = random.Random(seed)
+    extensions = [ext for exts in data["file_type_groups"].values() for ext in exts]
+    # unmatched extensions are part of a real download folder too
+    extensions += [".unknown", ".log", ".iso"]
+    names = []
+    for i in range(count):
+        parts = [f"file {i:07d}"]
+        if keywords and rand.random() < 0.2:
+            parts.append(f"kw{rand.randrange(keywords):05d}")
+        if rand.random() < 0.05:
+            parts.append("testing123")
+        names.append(" ".join(parts) + rand.choice(extensions))
+    return names
+
+
+def make_files(folder, names, mean_size, seed, fs=None):
+    """
+    Creates sparse files with a log-normal size distribution so large counts stay fast to build.
+    With a MemoryFileSystem the files are only added to it.
+    """
+    rand = random.Random(seed)
+    if fs is None:
+        os.makedirs(folder)
+    else:
+        fs.add_folder(folder)
+    for name in names:
+        size = int(rand.lognormvariate(0, 1.5) * mean_size)
+        if fs is None:
+            with open(os.path.join(folder, name), "wb") as f:
+                f.truncate(size)
+        else:
+            fs.add_file(os.path.join(folder, name), size)
+
+
+def timed(results, name, func, count):
+    """
+    Runs `func` with its output hidden and records its wall time.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+    results[name] = {
+        "seconds": round(seconds, 6),
+        "count": count,
+        "per_second": round(count / seconds, 1) if seconds else None,
+    }
+    print(f"{name:22} {seconds:10.4f}s {count:>10} items")
+
+
+def run_benchmark(args):
+    """
+    Builds the synthetic folder, times each phase and returns the results.
+    """
+    base = args.dir or ("/dev/shm" if os.path.isdir("/dev/shm") else None)
+    work_dir = tempfile.mkdtemp(prefix="cleaner-bench-", dir=base)
+    try:
+        config_path, data = make_config(work_dir, args.keywords, args.presets, args.seed)
+        names = make_names(data, args.files, args.keywords, args.seed)
+        watched = data["settings"]["watched_folder"]
+        fs = None
+        if args.simulate:
+            fs = MemoryFileSystem(latency=args.latency)
+            fs.add_folder(os.path.join(work_dir, "sorted", "keywords"))
+        make_files(watched, names, args.mean_size, args.seed, fs)
+        for i in range(args.empty_folders):
+            if fs is None:
+                os.makedirs(os.path.join(watched, f"empty {i}"))
+            else:
+                fs.add_folder(os.path.join(watched, f"empty {i}"))
+
+        App = Cleaner(config_path, fs)
+        results = {}
+        timed(results, "config_setup", App.config.setup, 1)
+        App.config.workers_per_device = args.workers
+
+        def classify():
+            for name in names:
+                App.set_destination(name)
+
+        def rename():
+            for name in names:
+                App.file_rename(watched, name)
+
+        timed(results, "set_destination", classify, len(names))
+        timed(results, "file_rename", rename, len(names))
+        timed(results, "setup_queue", App.setup_queue, len(names))
+        timed(results, "move_file_queue", App.move_file_queue, len(App.move_queue))
+        timed(
+            results,
+            "delete_empty_folders",
+            lambda: App.delete_empty_folders(watched),
+            args.empty_folders,
+        )
+        if fs is not None:
+            print(f"\n{'call':22} {'count':>10}")
+            for name, count in sorted(fs.calls.items()):
+                print(f"{name:22} {count:>10}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "settings": {
+            "files": args.files,
+            "keywords": args.keywords,
+            "presets": args.presets,
+            "mean_size": args.mean_size,
+            "empty_folders": args.empty_folders,
+            "workers": args.workers,
+            "seed": args.seed,
+            "simulate": args.simulate,
+            "latency": args.latency,
+        },
+        "results": results,
+    }
+
+
+def compare(current, previous_path) -> None:
+    """
+    Prints how much each phase changed compared to an earlier results file.
+    """
+    with open(previous_path) as json_file:
+        previous = json.load(json_file)
+    if previous["settings"] != current["settings"]:
+        print("\nWarning: the compared run used different settings.")
+    print(f"\n{'phase':22} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in current["results"].items():
+        before = previous["results"].get(name)
+        if not before:
+            continue
+        change = (result["seconds"] - before["seconds"]) / before["seconds"] * 100
+        print(
+            f"{name:22} {before['seconds']:10.4f} {result['seconds']:10.4f} {change:+7.1f}%"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Auto Folder Cleaner benchmarks")
+    parser.add_argument("--files", type=int, default=10000, help="number of files")
+    parser.add_argument("--keywords", type=int, default=100, help="generated keywords")
+    parser.add_argument("--presets", type=int, default=100, help="generated rename presets")
+    parser.add_argument("--mean-size", type=int, default=64 * 1024, help="typical file size")
+    parser.add_argument("--empty-folders", type=int, default=100, help="empty folders to delete")
+    parser.add_argument("--workers", type=int, default=2, help="workers per device")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--dir", help="where to build the folder, defaults to /dev/shm")
+    parser.add_argument(
+        "--simulate", action="store_true", help="use the in-memory filesystem instead of files"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds each simulated call takes"
+    )
+    parser.add_argument("--output", help="file to save the results to as JSON")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, "w") as json_file:
+            json.dump(results, json_file, indent=4)
+    if args.compare:
+        compare(results, args.compare)
@@ -1,5 +1,62 @@
 from main import Cleaner
-import unittest, os, shutil
+from utils.rules import KeywordMatcher, RuleIndex
+from utils.move_engine import MoveEngine
+from utils.transfer import transfer, copy_file, link_file, TransferCancelled
+from utils.watcher import Settler
+from utils.scan_index import ScanIndex
+from utils.tree_walk import TreeWalk
+from utils.dest_index import DestinationIndex
+from utils.renamer import Renamer
+from utils.plan import write_plan, read_plan, unchanged
+from utils.metrics import Metrics
+from utils.sniff import Sniffer, match_signature
+from utils.dedupe import Deduper
+from utils.journal import Journal, read_runs, recover_move
+from utils.throttle import RateLimiter
+from utils.progress import Progress
+from utils.retention import RetentionRules, DeadlineHeap, parse_duration
+from utils.records import QueueEntry, DestinationTable
+from utils.manifest import read_manifest
+from utils.filesystem import MemoryFileSystem
+from utils.sharding import ShardRule
+import unittest, contextlib, threading, datetime, json, time, io, os, shutil
+from unittest import mock
+
+
+def write_config(test_dir, sections=None, **settings):
+    """
+    Writes a copy of template_config.json to test_dir/config.json and returns its path.
+    The scan index, journal, manifest, progress bar and renaming are turned off so a
+    test never writes next to the real config unless it turns them back on.
+
+    Keyword arguments:
+
+    sections -- top level sections to change, dicts are merged into the template's
+    and anything else replaces it
+
+    settings -- settings to change
+    """
+    with open("template_config.json") as json_file:
+        data = json.load(json_file)
+    data["settings"].update(
+        {
+            "incremental_scan": False,
+            "journal": False,
+            "manifest_path": "",
+            "progress_bar": False,
+            "rename": False,
+        }
+    )
+    data["settings"].update(settings)
+    for name, section in (sections or {}).items():
+        if isinstance(section, dict) and isinstance(data.get(name), dict):
+            data[name].update(section)
+        else:
+            data[name] = section
+    config_path = f"{test_dir}/config.json"
+    with open(config_path, "w") as json_file:
+        json.dump(data, json_file)
+    return config_path
 
 
 class TestDestinationCheck(unittest.TestCase):
@@ -62,6 +119,55 @@ class FileRename(unittest.TestCase):
         self.assertEqual(result, "C:/DeLEtEthIs.png")
 
 
+class CompiledRename(unittest.TestCase):
+    """
+    Tests the single pass renamer compiled from file_rename presets.
+    """
+
+    def test_all_presets_applied(self):
+        """
+        Tests that every preset is applied in one pass.
+        """
+        renamer = Renamer({"deletethis": "", "this is a test": "Test Complete"})
+        result = renamer.rename("DELETETHIStHis iS a tEst.png")
+        self.assertEqual(result, "Test Complete.png")
+        self.assertEqual(renamer.rename("deletethis.png"), "deletethis.png")
+
+    def test_regex_and_templates(self):
+        """
+        Tests capture groups and the mtime and counter templates.
+        """
+        renamer = Renamer(
+            {
+                r"re:IMG_(\d{4})(\d{2})": r"Photo \1-\2",
+                "scan": "scan {counter}",
+                "export": "{mtime}",
+            }
+        )
+        self.assertEqual(renamer.rename("IMG_202301_5.jpg"), "Photo 2023-01_5.jpg")
+        self.assertEqual(renamer.rename("scan.pdf"), "scan 1.pdf")
+        self.assertEqual(renamer.rename("SCAN.pdf"), "scan 2.pdf")
+        date = datetime.date.fromtimestamp(0).isoformat()
+        self.assertEqual(renamer.rename("export.csv", mtime=0), f"{date}.csv")
+
+    def test_regex_groups(self):
+        """
+        Tests that regex presets keep their own backreferences and group names.
+        """
+        renamer = Renamer({"foo": "bar", r"re:(\w)\1": r"\1"})
+        self.assertEqual(renamer.rename("aabb.txt"), "ab.txt")
+        renamer = Renamer(
+            {
+                r"re:IMG_(?P<y>\d{4})": r"\g<y>",
+                r"re:VID_(?P<y>\d{4})": r"video \g<y>",
+            }
+        )
+        self.assertEqual(renamer.rename("IMG_2023.jpg"), "2023.jpg")
+        self.assertEqual(renamer.rename("VID_2024.mp4"), "video 2024.mp4")
+        with self.assertRaises(ValueError):
+            Renamer({"re:(unclosed": ""})
+
+
 class GetFileType(unittest.TestCase):
     def setUp(self):
         self.App = Cleaner(config="template_config.json")
@@ -145,6 +251,43 @@ class SetDestination(unittest.TestCase):
         self.assertEqual(result, "C:/Downloads/HD Videos")
 
 
+class RuleIndexClassify(unittest.TestCase):
+    """
+    Tests the compiled rule index used by set_destination.
+    """
+
+    def setUp(self):
+        self.rules = RuleIndex(
+            {"image": [".jpg", ".png"], "video": [".mp4", ".mkv"]},
+            {"image": "C:/Images", "video": "C:/Videos"},
+            {".mkv": "C:/HD Videos"},
+            {
+                "wallpaper": [[".jpg", ".png"], "C:/Wallpapers"],
+                "paper": [["video"], "C:/Paper Videos"],
+                "Sunset": [["image"], "C:/Sunsets"],
+            },
+        )
+
+    def test_overlapping_keywords(self):
+        """
+        Tests that every keyword is found even when they overlap.
+        """
+        matcher = KeywordMatcher(["wallpaper", "paper", "all"])
+        self.assertEqual(matcher.find("WallPaper.png"), {0, 1, 2})
+
+    def test_precedence(self):
+        """
+        Tests group, special case and keyword precedence.
+        """
+        self.assertEqual(self.rules.classify("clip.mp4", ".mp4"), "C:/Videos")
+        self.assertEqual(self.rules.classify("clip.mkv", ".mkv"), "C:/HD Videos")
+        self.assertEqual(self.rules.classify("paper.mkv", ".mkv"), "C:/Paper Videos")
+        self.assertEqual(self.rules.classify("wallpaper.png", ".png"), "C:/Wallpapers")
+        # the last matching keyword wins
+        self.assertEqual(self.rules.classify("sunset wallpaper.png", ".png"), "C:/Sunsets")
+        self.assertEqual(self.rules.classify("notes.txt", ".txt"), "skip")
+
+
 class SetupQueue(unittest.TestCase):
     def setUp(self):
         self.App = Cleaner(config="template_config.json")
@@ -173,6 +316,249 @@ class MoveFileQueue(unittest.TestCase):
         self.App.move_file_queue()
 
 
+class MoveEngineLimits(unittest.TestCase):
+    """
+    Tests the worker pool used by move_file_queue.
+    """
+
+    def test_per_device_limit(self):
+        """
+        Tests that no more than the set number of moves run on one device.
+        """
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def fake_move(entry):
+            with lock:
+                running.append(entry)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(entry)
+
+        queue = [{"destination": "test", "file_size": i} for i in range(12)]
+        done = []
+        engine = MoveEngine(fake_move, per_device=3)
+        errors = engine.run(queue, done.append)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(done), 12)
+        self.assertLessEqual(max(peak), 3)
+
+    def test_stream_bounded(self):
+        """
+        Tests that a streamed queue never holds more than max_in_flight entries.
+        """
+        done = []
+        backlog = []
+
+        def entries():
+            for i in range(50):
+                backlog.append(i - len(done))
+                yield {"destination": "test", "file_size": i}
+
+        engine = MoveEngine(lambda entry: time.sleep(0.001), per_device=2)
+        errors = engine.run_stream(entries(), done.append, max_in_flight=4)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(done), 50)
+        self.assertLessEqual(max(backlog), 4)
+
+    def test_large_file_lane(self):
+        """
+        Tests that small files keep moving while a large copy runs.
+        """
+        order = []
+
+        def fake_move(entry):
+            time.sleep(0.2 if entry["file_size"] >= 1000 else 0.01)
+            order.append(entry["file_size"])
+
+        queue = [{"destination": "test", "file_size": size} for size in [5000, 6000, 1, 2, 3]]
+        engine = MoveEngine(fake_move, per_device=2, large_file_size=1000)
+        self.assertEqual(engine.run(queue), [])
+        self.assertEqual(order[:3], [1, 2, 3])
+        self.assertEqual(sorted(order[3:]), [5000, 6000])
+
+    def test_stream_lanes(self):
+        """
+        Tests that streamed small files use every worker of a device with lanes set up
+        and still move while large copies run.
+        """
+        lock = threading.Lock()
+        running = []
+        peak = []
+        order = []
+
+        def fake_move(entry):
+            with lock:
+                running.append(entry)
+                peak.append(len(running))
+            time.sleep(0.2 if entry["file_size"] >= 1000 else 0.02)
+            with lock:
+                running.remove(entry)
+                order.append(entry["file_size"])
+
+        engine = MoveEngine(fake_move, per_device=4, large_file_size=1000)
+        small = [{"destination": "test", "file_size": 1} for _ in range(20)]
+        self.assertEqual(engine.run_stream(iter(small)), [])
+        self.assertEqual(max(peak), 4)
+
+        order.clear()
+        sizes = [5000, 6000, 7000, 1, 2, 3]
+        entries = [{"destination": "test", "file_size": size} for size in sizes]
+        self.assertEqual(engine.run_stream(iter(entries)), [])
+        self.assertEqual(sorted(order[:3]), [1, 2, 3])
+
+
+class BandwidthLimit(unittest.TestCase):
+    """
+    Tests the per device rate limiter used by chunked copies.
+    """
+
+    def test_rate(self):
+        limiter = RateLimiter(100_000)
+        start = time.monotonic()
+        # the first second of bandwidth is available as a burst
+        limiter.consume(100_000)
+        self.assertLess(time.monotonic() - start, 0.1)
+        limiter.consume(50_000)
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        cancel.set()
+        limiter = RateLimiter(1000)
+        start = time.monotonic()
+        limiter.consume(100_000, cancel)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+
+class TransferFile(unittest.TestCase):
+    """
+    Tests the rename fast path and chunked copy used by file_move.
+    """
+
+    test_dir = "test/transfer"
+
+    def setUp(self):
+        os.makedirs(f"{self.test_dir}/dest")
+        self.source = f"{self.test_dir}/file.bin"
+        with open(self.source, "wb") as f:
+            f.write(os.urandom(300_000))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_same_device_rename(self):
+        """
+        Tests that a move on the same filesystem is a rename.
+        """
+        result = transfer(self.source, f"{self.test_dir}/dest")
+        self.assertEqual(result, "rename")
+        self.assertTrue(os.path.exists(f"{self.test_dir}/dest/file.bin"))
+
+    def test_chunked_copy(self):
+        """
+        Tests that a chunked copy matches the source.
+        """
+        copy = f"{self.test_dir}/dest/copy.bin"
+        copy_file(self.source, copy, chunk_size=4096)
+        with open(self.source, "rb") as a, open(copy, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_cancel_removes_partial(self):
+        """
+        Tests that a cancelled copy leaves nothing behind.
+        """
+        cancel = threading.Event()
+        cancel.set()
+        with self.assertRaises(TransferCancelled):
+            copy_file(self.source, f"{self.test_dir}/dest/copy.bin", cancel)
+        self.assertEqual(os.listdir(f"{self.test_dir}/dest"), [])
+
+    def test_short_kernel_copy(self):
+        """
+        Tests that a kernel copy ending early falls back to read and write, and that
+        a copy that still comes up short keeps the source and leaves nothing behind.
+        """
+        other_device = lambda path: -1
+        with mock.patch("utils.transfer.device_id", other_device), mock.patch(
+            "utils.transfer.kernel_copy", return_value=0
+        ):
+            self.assertEqual(transfer(self.source, f"{self.test_dir}/dest/a.bin"), "copy")
+            self.assertEqual(os.path.getsize(f"{self.test_dir}/dest/a.bin"), 300_000)
+            with open(self.source, "wb") as f:
+                f.write(os.urandom(300_000))
+            with mock.patch("utils.transfer.read_write_copy", return_value=0):
+                with self.assertRaises(OSError):
+                    transfer(self.source, f"{self.test_dir}/dest/b.bin")
+        self.assertTrue(os.path.exists(self.source))
+        self.assertEqual(os.listdir(f"{self.test_dir}/dest"), ["a.bin"])
+
+
+class WatchSettler(unittest.TestCase):
+    """
+    Tests that watch mode holds files until they stop changing.
+    """
+
+    test_dir = "test/watch"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+        for name in ["done.txt", "download.mp4.part"]:
+            with open(f"{self.test_dir}/{name}", "w") as f:
+                f.write("data")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_settle_window(self):
+        """
+        Tests that files are ready only after the settle window and partial downloads never are.
+        """
+        settler = Settler(self.test_dir, settle_seconds=0.05, partial_suffixes=[".part"])
+        settler.add(os.listdir(self.test_dir))
+        self.assertEqual(settler.ready(), [])
+        time.sleep(0.1)
+        self.assertEqual(settler.ready(), ["done.txt"])
+        self.assertEqual(settler.pending, {})
+
+
+class IncrementalScanIndex(unittest.TestCase):
+    """
+    Tests the scan index that lets setup_queue skip unchanged files.
+    """
+
+    test_dir = "test/scan index"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+        self.index_path = f"{self.test_dir}/index.json"
+        self.file = f"{self.test_dir}/notes.unknown"
+        with open(self.file, "w") as f:
+            f.write("data")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_known_until_changed(self):
+        """
+        Tests that a remembered file is skipped until it or the config changes.
+        """
+        index = ScanIndex(self.index_path, "hash")
+        index.remember("notes.unknown", os.stat(self.file))
+        index.save()
+
+        index = ScanIndex(self.index_path, "hash")
+        self.assertTrue(index.is_known("notes.unknown", os.stat(self.file)))
+        with open(self.file, "a") as f:
+            f.write("more data")
+        self.assertFalse(index.is_known("notes.unknown", os.stat(self.file)))
+
+        index = ScanIndex(self.index_path, "new hash")
+        self.assertEqual(index.entries, {})
+
+
 class DeleteEmptyFolders(unittest.TestCase):
     """
     Tests delete_empty_folders function.
@@ -220,6 +606,828 @@ class DeleteEmptyFolders(unittest.TestCase):
         total_folders = len(os.listdir(self.test_dir))
         self.assertEqual(total_folders, 1)
 
+class RecursiveTreeWalk(unittest.TestCase):
+    """
+    Tests the single pass walk used for recursive cleaning.
+    """
+
+    test_dir = "test/tree walk"
+
+    def setUp(self):
+        for folder in ["a/b/c", "a/keep", "dest/empty", "d"]:
+            os.makedirs(f"{self.test_dir}/{folder}")
+        for path in ["a/b/moved.txt", "a/keep/stay.txt"]:
+            with open(f"{self.test_dir}/{path}", "w") as f:
+                f.write("data")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_prune_bottom_up(self):
+        """
+        Tests that folders left empty after moves are removed bottom-up and
+        excluded folders are skipped.
+        """
+        walk = TreeWalk(self.test_dir, [f"{self.test_dir}/dest"])
+        files = {os.path.basename(entry.path): entry for entry in walk.files()}
+        self.assertEqual(sorted(files), ["moved.txt", "stay.txt"])
+        os.remove(files["moved.txt"].path)
+        walk.claim(files["moved.txt"].path)
+        self.assertEqual(walk.prune(), 3)
+        self.assertEqual(sorted(os.listdir(self.test_dir)), ["a", "dest"])
+        self.assertEqual(os.listdir(f"{self.test_dir}/a"), ["keep"])
+
+
+class DestinationCollisions(unittest.TestCase):
+    """
+    Tests collision handling against the destination index.
+    """
+
+    test_dir = "test/dest index"
+
+    def setUp(self):
+        os.makedirs(f"{self.test_dir}/dest")
+        for name in ["photo.png", "photo (1).png"]:
+            with open(f"{self.test_dir}/dest/{name}", "w") as f:
+                f.write("old")
+        self.source = f"{self.test_dir}/photo.png"
+        with open(self.source, "w") as f:
+            f.write("new")
+        os.utime(f"{self.test_dir}/dest/photo.png", (0, 0))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_policies(self):
+        """
+        Tests the skip, suffix and newer policies.
+        """
+        dest = f"{self.test_dir}/dest"
+        for policy, answer in [
+            ("skip", (None, False)),
+            ("suffix", ("photo (2).png", False)),
+            ("newer", ("photo.png", True)),
+        ]:
+            with self.subTest(policy=policy):
+                index = DestinationIndex(policy)
+                self.assertEqual(index.resolve(dest, "photo.png", self.source), answer)
+                self.assertEqual(index.resolve(dest, "other.png", self.source), ("other.png", False))
+
+    def test_missing_folder(self):
+        """
+        Tests that a missing folder is listed once and updated as files land.
+        """
+        index = DestinationIndex()
+        folder = f"{self.test_dir}/missing"
+        self.assertFalse(index.folder_exists(folder))
+        index.add(folder, "file.txt")
+        self.assertTrue(index.contains(folder, "file.txt"))
+
+
+class PlanFile(unittest.TestCase):
+    """
+    Tests writing and reading plan files.
+    """
+
+    test_dir = "test/plan"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+        self.file = f"{self.test_dir}/photo.png"
+        with open(self.file, "w") as f:
+            f.write("data")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        """
+        Tests that a plan reads back as queue entries and detects changed files.
+        """
+        entry = {
+            "file_name": "photo.png",
+            "file_size": 4,
+            "target": self.file,
+            "destination": "C:/Images",
+            "new_name": "Photo.png",
+            "mtime": os.stat(self.file).st_mtime_ns,
+        }
+        path = f"{self.test_dir}/plan.json"
+        write_plan(path, "hash", self.test_dir, [entry], [])
+        plan = read_plan(path)
+        self.assertEqual(plan["moves"], [entry])
+        self.assertEqual(plan["deletions"], [])
+        self.assertTrue(unchanged(plan["moves"][0]))
+        with open(self.file, "a") as f:
+            f.write("more")
+        self.assertFalse(unchanged(plan["moves"][0]))
+
+
+class RunMetrics(unittest.TestCase):
+    """
+    Tests the metrics collected during a run.
+    """
+
+    def test_report(self):
+        """
+        Tests phase times, syscall counts and the latency histogram.
+        """
+        metrics = Metrics()
+        with metrics.phase("scan"):
+            with metrics.count_syscalls():
+                os.listdir("test")
+        metrics.record_move("test", 100, 0.0, 0.002, "rename")
+        metrics.record_move("test", 300, 1.0, 3.0, "copy")
+        report = metrics.report()
+        self.assertIn("scan", report["phases"])
+        self.assertEqual(report["syscalls"], {"listdir": 1})
+        self.assertEqual(report["transfer_methods"], {"rename": 1, "copy": 1})
+        self.assertEqual(report["move_latency"]["buckets"]["0.005"], 1)
+        self.assertEqual(report["move_latency"]["buckets"]["+Inf"], 2)
+        (device,) = report["devices"].values()
+        self.assertEqual(device["bytes"], 400)
+        self.assertEqual(device["files"], 2)
+
+
+class ContentSniffing(unittest.TestCase):
+    """
+    Tests classifying files by their header when the extension matches no rule.
+    """
+
+    test_dir = "test/sniffing"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+        self.cache_path = f"{self.test_dir}/cache.json"
+        self.file = f"{self.test_dir}/download"
+        with open(self.file, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + bytes(100))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_signatures(self):
+        self.assertEqual(match_signature(b"%PDF-1.7"), ".pdf")
+        self.assertEqual(match_signature(b"\x00\x00\x00\x18ftypmp42"), ".mp4")
+        self.assertEqual(match_signature(b"RIFF\x00\x00\x00\x00WAVEfmt "), ".wav")
+        self.assertIsNone(match_signature(b"plain text"))
+
+    def test_cached_by_inode_size_mtime(self):
+        """
+        Tests that a cached header is not read again until the file changes.
+        """
+        sniffer = Sniffer(self.cache_path)
+        self.assertEqual(sniffer.sniff(self.file), ".png")
+        sniffer.save()
+
+        sniffer = Sniffer(self.cache_path)
+        with open(self.file, "r+b") as f:
+            f.write(b"%PDF-")
+        os.utime(self.file, ns=(0, 0))
+        self.assertEqual(sniffer.sniff(self.file), ".pdf")
+        # unseen entries are dropped on save
+        sniffer.save()
+        self.assertEqual(list(Sniffer(self.cache_path).cache.values()), [".pdf"])
+
+    def test_queue_entry(self):
+        """
+        Tests that only files whose extension misses the rules are sniffed.
+        """
+        App = Cleaner(config="template_config.json")
+        App.config.setup()
+        App.sniffer = Sniffer()
+        entry = App.queue_entry("download", self.file)
+        self.assertEqual(entry["destination"], App.config.file_group_dest["image"])
+        shutil.copyfile(self.file, f"{self.test_dir}/song.mp3")
+        entry = App.queue_entry("song.mp3", f"{self.test_dir}/song.mp3")
+        self.assertEqual(entry["destination"], App.config.file_group_dest["audio"])
+        self.assertEqual(len(App.sniffer.cache), 1)
+        self.assertEqual(App.get_file_type("download"), "")
+
+
+class DuplicateDetection(unittest.TestCase):
+    """
+    Tests finding files whose content is already in their destination.
+    """
+
+    test_dir = "test/duplicates"
+
+    def setUp(self):
+        self.dest = f"{self.test_dir}/dest"
+        self.incoming = f"{self.test_dir}/incoming"
+        os.makedirs(self.dest)
+        os.makedirs(self.incoming)
+        self.data = os.urandom(300 * 1024)
+        self.write(f"{self.dest}/archive.bin", self.data)
+        self.write(f"{self.dest}/small.txt", b"small file")
+        # same size, first and last blocks as the archive but a different middle
+        changed = self.data[:150000] + b"x" + self.data[150001:]
+        self.entries = [
+            self.entry("copy.bin", self.data),
+            self.entry("changed.bin", changed),
+            self.entry("unique.bin", b"unique size"),
+            self.entry("small copy.txt", b"small file"),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    @staticmethod
+    def write(path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def entry(self, name, data):
+        path = f"{self.incoming}/{name}"
+        self.write(path, data)
+        return {
+            "file_name": name,
+            "file_size": len(data),
+            "target": path,
+            "destination": self.dest,
+        }
+
+    def test_staged_hashing(self):
+        """
+        Tests that only real copies are found and unique sizes are never hashed.
+        """
+        cache_path = f"{self.test_dir}/hashes.json"
+        deduper = Deduper(cache_path, workers=2)
+        duplicates = deduper.find(self.entries)
+        found = {entry["file_name"]: os.path.basename(path) for entry, path in duplicates}
+        self.assertEqual(found, {"copy.bin": "archive.bin", "small copy.txt": "small.txt"})
+        # 5 partial hashes and 3 full hashes for the large files
+        self.assertEqual(deduper.files_hashed, 8)
+        # hashes are reused from the cache on the next run
+        deduper = Deduper(cache_path)
+        self.assertEqual(len(deduper.find(self.entries)), 2)
+        self.assertEqual(deduper.files_hashed, 0)
+
+    def test_hardlink(self):
+        """
+        Tests that a duplicate is moved by hard linking the existing copy.
+        """
+        App = Cleaner(config="template_config.json")
+        App.config.setup()
+        App.config.rename = False
+        method = App.file_move(
+            f"{self.incoming}/copy.bin", self.dest, duplicate_of=f"{self.dest}/archive.bin"
+        )
+        self.assertEqual(method, "hardlink")
+        self.assertFalse(os.path.exists(f"{self.incoming}/copy.bin"))
+        self.assertTrue(os.path.samefile(f"{self.dest}/copy.bin", f"{self.dest}/archive.bin"))
+
+    def test_unknown_action(self):
+        """
+        Tests that a misspelled duplicate_action is reported when the config loads.
+        """
+        App = Cleaner(config=write_config(self.test_dir, duplicate_action="delte"))
+        with self.assertRaises(ValueError):
+            App.config.setup()
+
+
+class MoveJournal(unittest.TestCase):
+    """
+    Tests recovering interrupted runs and undoing runs from the move journal.
+    """
+
+    test_dir = "test/journal"
+
+    def setUp(self):
+        self.source = f"{self.test_dir}/source"
+        self.dest = f"{self.test_dir}/dest"
+        os.makedirs(self.source)
+        os.makedirs(self.dest)
+        config_path = write_config(
+            self.test_dir, journal=True, journal_path=f"{self.test_dir}/journal.jsonl"
+        )
+        self.App = Cleaner(config=config_path)
+        self.App.config.setup()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def make_file(self, path):
+        with open(path, "w") as f:
+            f.write(path)
+
+    def test_group_commit(self):
+        """
+        Tests that moves running at once share fsyncs and are all recorded.
+        """
+        journal = Journal(self.App.config.journal_path)
+        journal.open()
+        threads = []
+        for i in range(20):
+            thread = threading.Thread(
+                target=lambda i=i: journal.finish_move(journal.plan_move(f"a{i}", f"b{i}"), "rename")
+            )
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        journal.close()
+        self.assertLess(journal.commits, 42)
+        run = read_runs(self.App.config.journal_path)[journal.run_id]
+        self.assertTrue(run["ended"])
+        self.assertEqual({move["state"] for move in run["moves"].values()}, {"done"})
+
+    def test_recover_and_undo(self):
+        """
+        Tests that an interrupted run is finished or rolled back and can then be undone.
+        """
+        # a crash after one file was renamed and while another was being copied
+        self.make_file(f"{self.dest}/moved.txt")
+        self.make_file(f"{self.source}/copying.txt")
+        self.make_file(f"{self.dest}/.copying.txt.abc.part")
+        journal = Journal(self.App.config.journal_path)
+        journal.open()
+        journal.plan_move(f"{self.source}/moved.txt", f"{self.dest}/moved.txt")
+        journal.plan_move(f"{self.source}/copying.txt", f"{self.dest}/copying.txt")
+        with journal.condition:
+            journal.closing = True
+            journal.condition.notify_all()
+        journal.thread.join()
+
+        with self.App.journal_context():
+            pass
+        self.assertEqual(os.listdir(self.dest), ["moved.txt"])
+        run = read_runs(self.App.config.journal_path)[journal.run_id]
+        self.assertTrue(run["ended"])
+
+        self.App.undo()
+        self.assertEqual(sorted(os.listdir(self.source)), ["copying.txt", "moved.txt"])
+        self.assertEqual(os.listdir(self.dest), [])
+
+
+class MultipleWatchedFolders(unittest.TestCase):
+    """
+    Tests cleaning several watched folders with per folder overrides in one run.
+    """
+
+    test_dir = "test/multiple folders"
+
+    def setUp(self):
+        self.downloads = f"{self.test_dir}/Downloads"
+        self.desktop = f"{self.test_dir}/Desktop"
+        os.makedirs(self.downloads)
+        os.makedirs(self.desktop)
+        for folder in [self.downloads, self.desktop]:
+            with open(f"{folder}/testing123.png", "w") as f:
+                f.write(folder)
+        config_path = write_config(
+            self.test_dir,
+            {"file_group_dest": {"image": f"{self.test_dir}/Images"}},
+            rename=True,
+            watched_folders=[
+                self.downloads,
+                {
+                    "path": self.desktop,
+                    "rename": False,
+                    "file_group_dest": {"image": f"{self.test_dir}/Desktop Images"},
+                },
+            ],
+        )
+        self.App = Cleaner(config=config_path)
+        self.App.config.setup()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_overrides(self):
+        """
+        Tests that only the folder with overrides gets its own rules and rename setting.
+        """
+        downloads, desktop = self.App.config.folders
+        self.assertIs(downloads.rules, self.App.config.rules)
+        self.assertIsNot(desktop.rules, self.App.config.rules)
+        self.assertIn(f"{self.test_dir}/Desktop Images", self.App.config.all_destinations())
+
+        self.App.move_queue = list(self.App.scan_queue_entries())
+        self.App.queue_size = 0
+        self.assertEqual(len(self.App.move_queue), 2)
+        self.App.move_file_queue()
+        self.assertEqual(os.listdir(f"{self.test_dir}/Images"), ["test_complete.png"])
+        self.assertEqual(os.listdir(f"{self.test_dir}/Desktop Images"), ["testing123.png"])
+
+
+class MoveProgress(unittest.TestCase):
+    """
+    Tests progress reported from chunked copies and batched into fixed rate events.
+    """
+
+    test_dir = "test/progress"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_batched_events(self):
+        """
+        Tests that many finished files only send one event per interval.
+        """
+        events = []
+        progress = Progress(10_000, 1000, [events.append], interval=60)
+        for _ in range(1000):
+            progress.file_done(10)
+        progress.close()
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[-1]["bytes_done"], 10_000)
+        self.assertEqual(events[-1]["files_done"], 1000)
+        self.assertTrue(events[-1]["finished"])
+
+    def test_chunks(self):
+        """
+        Tests that a copy reports each chunk and the file is only counted once.
+        """
+        source = f"{self.test_dir}/file.bin"
+        with open(source, "wb") as f:
+            f.write(os.urandom(300_000))
+        chunks = []
+        copy_file(source, f"{self.test_dir}/copy.bin", chunk_size=64 * 1024, on_chunk=chunks.append)
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(sum(chunks), 300_000)
+
+        events = []
+        App = Cleaner(config="template_config.json")
+        App.config.setup()
+        App.start_progress(None, 300_000, 1).callbacks.append(events.append)
+        App.move_entry(
+            {
+                "file_name": "copy.bin",
+                "file_size": 300_000,
+                "target": f"{self.test_dir}/copy.bin",
+                "destination": f"{self.test_dir}/dest",
+            }
+        )
+        App.progress.close()
+        self.assertEqual(events[-1]["bytes_done"], 300_000)
+        self.assertEqual(events[-1]["files_done"], 1)
+
+
+class RetentionRuleDeadlines(unittest.TestCase):
+    """
+    Tests age and size based retention rules and the deadline heap used by watch mode.
+    """
+
+    test_dir = "test/retention"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_rules(self):
+        self.assertEqual(parse_duration("10m"), 600)
+        self.assertEqual(parse_duration("3d"), 259200)
+        self.assertEqual(parse_duration(90), 90)
+        rules = RetentionRules(
+            [
+                {"file_types": [".tmp"], "min_age": "24h", "action": "delete"},
+                {"file_group": "executable", "min_size": 100, "min_age": "3d"},
+            ]
+        )
+        self.assertEqual(rules.rule_for(".TMP", None, 0).action, "delete")
+        self.assertEqual(rules.rule_for(".exe", "executable", 500).min_age, 259200)
+        self.assertIsNone(rules.rule_for(".exe", "executable", 50))
+
+    def test_heap(self):
+        """
+        Tests that deadlines come out in order and a pushed key replaces its old deadline.
+        """
+        heap = DeadlineHeap()
+        heap.push(30, "c")
+        heap.push(10, "a")
+        heap.push(20, "b")
+        heap.push(40, "a")
+        self.assertEqual(heap.next_deadline(), 20)
+        self.assertEqual(heap.pop_due(35), ["b", "c"])
+        self.assertEqual(heap.pop_due(100), ["a"])
+        self.assertIsNone(heap.next_deadline())
+
+    def test_scan(self):
+        """
+        Tests that a scan holds new files, deletes expired ones and moves due ones.
+        """
+        rules = [
+            {"file_types": [".log"], "min_age": "1d", "action": "delete"},
+            {"file_group": "image", "min_age": "1h"},
+        ]
+        config_path = write_config(
+            self.test_dir, {"retention_rules": rules}, watched_folder=self.test_dir
+        )
+        old = time.time() - 2 * 86400
+        for name in ["old.log", "new.log", "old.png", "new.png"]:
+            with open(f"{self.test_dir}/{name}", "w") as f:
+                f.write(name)
+            if name.startswith("old"):
+                os.utime(f"{self.test_dir}/{name}", (old, old))
+        App = Cleaner(config=config_path)
+        App.config.setup()
+        entries = list(App.scan_queue_entries())
+        self.assertEqual([entry["file_name"] for entry in entries], ["old.png"])
+        self.assertFalse(os.path.exists(f"{self.test_dir}/old.log"))
+        self.assertTrue(os.path.exists(f"{self.test_dir}/new.log"))
+        self.assertEqual(App.metrics.counters["files_held"], 2)
+
+    def test_dry_run(self):
+        """
+        Tests that a dry run plans expired files as deletions without deleting them.
+        """
+        rules = [{"file_types": [".log"], "min_age": "1d", "action": "delete"}]
+        config_path = write_config(
+            self.test_dir, {"retention_rules": rules}, watched_folder=self.test_dir
+        )
+        old = time.time() - 2 * 86400
+        with open(f"{self.test_dir}/old.log", "w") as f:
+            f.write("old.log")
+        os.utime(f"{self.test_dir}/old.log", (old, old))
+        App = Cleaner(config=config_path)
+        App.make_plan(f"{self.test_dir}/plan.json", dry_run=True)
+        self.assertTrue(os.path.exists(f"{self.test_dir}/old.log"))
+        self.assertEqual([entry["file_name"] for entry in App.expired_files], ["old.log"])
+        self.assertNotIn("files_expired", App.metrics.counters)
+
+
+class QueueRecords(unittest.TestCase):
+    """
+    Tests the compact queue entries and the manifest written while files move.
+    """
+
+    test_dir = "test/records"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_entry(self):
+        """
+        Tests that entries read like dicts and share one copy of each destination.
+        """
+        table = DestinationTable()
+        first = QueueEntry("dl/a.png", 10, table.intern("".join(["C:/", "Images"])))
+        second = QueueEntry("dl/b.png", 20, table.intern("".join(["C:/", "Images"])))
+        self.assertIs(first.destination, second.destination)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(first["file_name"], "a.png")
+        self.assertEqual(first.get("new_name", "same"), "same")
+        self.assertNotIn("folder", first)
+        first["duplicate_of"] = "C:/Images/c.png"
+        self.assertIn("duplicate_of", first)
+        with self.assertRaises(KeyError):
+            first["mtime"]
+        self.assertFalse(hasattr(first, "__dict__"))
+
+    def test_manifest(self):
+        """
+        Tests that moved and skipped files are written to CSV and JSON lines manifests.
+        """
+        App = Cleaner(config="template_config.json")
+        App.config.setup()
+        destination = f"{self.test_dir}/dest"
+        os.makedirs(destination)
+        with open(f"{destination}/b.txt", "w") as f:
+            f.write("existing")
+        for path in [f"{self.test_dir}/manifest.csv", f"{self.test_dir}/manifest.jsonl"]:
+            for name in ["a.txt", "b.txt"]:
+                with open(f"{self.test_dir}/{name}", "w") as f:
+                    f.write(name)
+            App.manifest_path = path
+            App.dest_index = DestinationIndex("skip")
+            with App.manifest_context():
+                for name in ["a.txt", "b.txt"]:
+                    App.move_entry(QueueEntry(f"{self.test_dir}/{name}", 5, destination))
+            rows = list(read_manifest(path))
+            self.assertEqual(App.manifest_rows, 2)
+            self.assertEqual(App.manifest_moved, 1)
+            self.assertEqual([row["method"] for row in rows], ["rename", "skip"])
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                App.print_manifest(App.manifest_moved)
+            self.assertIn("Name: a.txt", output.getvalue())
+            self.assertNotIn("Name: b.txt", output.getvalue())
+            self.assertEqual(rows[0]["destination"], f"{destination}/a.txt")
+            self.assertEqual(rows[0]["file_size"], 5)
+            os.remove(f"{destination}/a.txt")
+
+
+class SimulatedFileSystem(unittest.TestCase):
+    """
+    Tests running the cleaner against the in-memory filesystem backend.
+    """
+
+    test_dir = "test/simulated"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_run(self):
+        """
+        Tests that files are moved, skipped and copied between simulated devices with
+        every call counted and nothing touching the real disk.
+        """
+        config_path = write_config(
+            self.test_dir, journal=True, journal_path=f"{self.test_dir}/journal.jsonl"
+        )
+        fs = MemoryFileSystem(devices={"C:/Downloads/Videos": 2})
+        for name in ["a.png", "b.mp4", "c.png"]:
+            fs.add_file(f"C:/Downloads/{name}", 20_000_000)
+        fs.add_file("C:/Downloads/Images/c.png", 10)
+        fs.add_folder("C:/Downloads/Videos")
+        fs.add_folder("C:/Downloads/empty")
+        App = Cleaner(config=config_path, fs=fs)
+        App.config.setup()
+        App.move_queue = list(App.scan_queue_entries())
+        App.queue_size = sum(entry["file_size"] for entry in App.move_queue)
+        with App.journal_context():
+            App.move_file_queue()
+        App.clean_empty_folders()
+        self.assertEqual(fs.stat("C:/Downloads/Images/a.png").st_size, 20_000_000)
+        self.assertEqual(fs.stat("C:/Downloads/Videos/b.mp4").st_dev, 2)
+        self.assertTrue(fs.exists("C:/Downloads/c.png"))
+        self.assertFalse(fs.exists("C:/Downloads/empty"))
+        self.assertEqual(fs.calls["replace"], 1)
+        self.assertEqual(fs.calls["copy_file_range"], 3)
+        self.assertEqual(fs.calls["rmdir"], 3)
+        self.assertFalse(os.path.exists("C:"))
+        # simulated moves are not journaled and their devices come from the backend
+        self.assertFalse(os.path.exists(f"{self.test_dir}/journal.jsonl"))
+        self.assertEqual(sorted(App.metrics.devices), ["0", "2"])
+
+
+class DestinationSharding(unittest.TestCase):
+    """
+    Tests spreading destinations over subfolders and resharding existing ones.
+    """
+
+    test_dir = "test/sharding"
+
+    def setUp(self):
+        os.makedirs(self.test_dir)
+        sharding = {
+            "C:/Downloads/Images": "{year}/{month}",
+            "C:/Downloads/Documents": {"template": "{name:.1}", "max_entries": 2},
+        }
+        self.config_path = write_config(self.test_dir, {"destination_sharding": sharding})
+        self.fs = MemoryFileSystem()
+        self.mtime = datetime.datetime(2024, 5, 9, 12).timestamp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_rule(self):
+        rule = ShardRule("{year}/{month}")
+        self.assertEqual(rule.subfolder("a.png", self.mtime), os.path.join("2024", "05"))
+        rule = ShardRule("{name:.2}/{type}")
+        self.assertEqual(rule.subfolder("Report.PDF"), os.path.join("re", "pdf"))
+        self.assertEqual(ShardRule("{name:.1}").subfolder(".hidden"), "_")
+        with self.assertRaises(ValueError):
+            ShardRule("{size}")
+
+    def test_run(self):
+        """
+        Tests that queued files get their shard and every shard is made before moving.
+        """
+        for name in ["a.png", "b.png", "alpha.txt", "apple.txt", "avocado.txt", "beta.txt"]:
+            self.fs.add_file(f"C:/Downloads/{name}", 10, self.mtime)
+        self.fs.add_folder("C:/Downloads/Images")
+        App = Cleaner(config=self.config_path, fs=self.fs)
+        App.config.setup()
+        App.move_queue = list(App.scan_queue_entries())
+        App.queue_size = 0
+        App.move_file_queue()
+        self.assertEqual(len(self.fs.folders["C:/Downloads/Images/2024/05"]), 2)
+        self.assertIn("avocado.txt", self.fs.folders["C:/Downloads/Documents/a/0002"])
+        self.assertEqual(len(self.fs.folders["C:/Downloads/Documents/a/0001"]), 2)
+        self.assertEqual(list(self.fs.folders["C:/Downloads/Documents/b/0001"]), ["beta.txt"])
+        # Documents did not exist so it is made along with its shards
+        self.assertEqual(self.fs.calls["mkdir"], 8)
+
+    def test_reshard(self):
+        """
+        Tests that files already in a sharded destination move into their subfolders.
+        """
+        for name in ["a.png", "b.png"]:
+            self.fs.add_file(f"C:/Downloads/Images/{name}", 10, self.mtime)
+        self.fs.add_file(f"C:/Downloads/Images/2024/05/a.png", 10, self.mtime)
+        App = Cleaner(config=self.config_path, fs=self.fs)
+        App.reshard("C:/Downloads/Images")
+        self.assertEqual(list(self.fs.folders["C:/Downloads/Images"]), ["a.png", "2024"])
+        self.assertEqual(len(self.fs.folders["C:/Downloads/Images/2024/05"]), 2)
+
+
+class OrganizeMode(unittest.TestCase):
+    """
+    Tests placing files with reflinks, hard links or copies while leaving the source.
+    """
+
+    test_dir = "test/organize"
+
+    def setUp(self):
+        os.makedirs(f"{self.test_dir}/dest")
+        self.source = f"{self.test_dir}/photo.png"
+        with open(self.source, "w") as f:
+            f.write("data")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def test_link_file(self):
+        """
+        Tests that a file on the same filesystem is cloned or linked and the source stays.
+        """
+        method = link_file(self.source, f"{self.test_dir}/dest")
+        self.assertIn(method, ["reflink", "hardlink"])
+        self.assertTrue(os.path.exists(self.source))
+        with open(f"{self.test_dir}/dest/photo.png") as f:
+            self.assertEqual(f.read(), "data")
+        with self.assertRaises(FileExistsError):
+            link_file(self.source, f"{self.test_dir}/dest", mode="hardlink")
+        self.assertEqual(link_file(self.source, self.source), "skip")
+
+    def test_recover_keeps_source(self):
+        """
+        Tests that recovering an organized file never removes its source.
+        """
+        shutil.copy2(self.source, f"{self.test_dir}/dest/photo.png")
+        move = {"src": self.source, "dst": f"{self.test_dir}/dest/photo.png", "keep": True}
+        self.assertEqual(recover_move(move), "done")
+        self.assertTrue(os.path.exists(self.source))
+
+    def test_simulated_run(self):
+        """
+        Tests that organize mode links on the same device, copies across devices and
+        reports the method of every file.
+        """
+        config_path = write_config(self.test_dir, organize_mode="hardlink")
+        fs = MemoryFileSystem(devices={"C:/Downloads/Videos": 2})
+        for name in ["a.png", "b.mp4"]:
+            fs.add_file(f"C:/Downloads/{name}", 100)
+        App = Cleaner(config=config_path, fs=fs)
+        App.config.setup()
+        App.move_queue = list(App.scan_queue_entries())
+        App.queue_size = 0
+        App.move_file_queue()
+        self.assertEqual(App.metrics.methods, {"hardlink": 1, "copy": 1})
+        self.assertTrue(fs.exists("C:/Downloads/a.png"))
+        self.assertTrue(fs.exists("C:/Downloads/b.mp4"))
+        source, placed = fs.stat("C:/Downloads/a.png"), fs.stat("C:/Downloads/Images/a.png")
+        self.assertEqual(source.st_ino, placed.st_ino)
+        self.assertEqual(fs.stat("C:/Downloads/Videos/b.mp4").st_dev, 2)
+
+    def test_repeated_runs(self):
+        """
+        Tests that files placed by an earlier run are not placed again under a suffix.
+        """
+        config_path = write_config(self.test_dir, collision_policy="suffix")
+        fs = MemoryFileSystem(devices={"C:/Downloads/Videos": 2})
+        fs.add_file("C:/Downloads/a.png", 100)
+        fs.add_file("C:/Downloads/b.mp4", 100)
+        fs.add_file("C:/Downloads/Images/a.png", 50)
+        for mode in ["hardlink", "reflink", "hardlink"]:
+            App = Cleaner(config=config_path, fs=fs)
+            App.config.setup()
+            App.organize_mode = mode
+            App.move_queue = list(App.scan_queue_entries())
+            App.queue_size = 0
+            App.move_file_queue()
+        self.assertEqual(sorted(fs.folders["C:/Downloads/Images"]), ["a (1).png", "a.png"])
+        self.assertEqual(list(fs.folders["C:/Downloads/Videos"]), ["b.mp4"])
+
+    def test_duplicates_keep_source(self):
+        """
+        Tests that the link placed by an earlier organize run is not taken for a
+        duplicate that gets the source deleted.
+        """
+        config_path = write_config(
+            self.test_dir,
+            {"file_group_dest": {"image": f"{self.test_dir}/dest"}},
+            watched_folder=self.test_dir,
+            organize_mode="hardlink",
+            duplicate_action="delete",
+            collision_policy="suffix",
+            hash_cache_path=f"{self.test_dir}/hash_cache.json",
+            ask_to_delete=False,
+        )
+        for _ in range(2):
+            App = Cleaner(config=config_path)
+            App.config.setup()
+            App.move_queue = App.handle_duplicates(list(App.scan_queue_entries()))
+            App.queue_size = 0
+            App.move_file_queue()
+        self.assertTrue(os.path.exists(self.source))
+        self.assertEqual(os.listdir(f"{self.test_dir}/dest"), ["photo.png"])
+        entry = QueueEntry(self.source, 4, f"{self.test_dir}/dest")
+        self.assertEqual(Deduper().find([entry]), [])
+
 
 if __name__ == "__main__":
     unittest.main()
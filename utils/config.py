@@ -1,6 +1,34 @@
-import shutil, json
+import hashlib, shutil, pickle, json, os
 from pathlib import Path
 
+from utils.rules import RuleIndex
+from utils.renamer import Renamer
+from utils.retention import RetentionRules
+from utils.sharding import ShardRules
+from utils.transfer import ORGANIZE_MODES
+
+# bump when the compiled config changes shape so old caches are ignored
+CACHE_VERSION = 11
+
+# destination rules a watched folder can replace entries of
+RULE_OVERRIDES = ["file_group_dest", "special_case_dest", "keywords_dest"]
+
+
+class WatchedFolder:
+    """
+    A watched folder and the settings it cleans with. Folders without rule overrides
+    share the rule index compiled for the whole config.
+    """
+
+    def __init__(self, path, rules, rename, recursive, destinations) -> None:
+        self.path = path
+        self.rules = rules
+        self.rename = rename
+        self.recursive = recursive
+        # destination folders the rules of this folder can move files to
+        self.destinations = destinations
+
+
 class Config:
 
 
@@ -16,16 +44,29 @@ class Config:
 
     def setup(self):
         """
-        Initializes settings from config.
+        Initializes settings from config. The parsed and compiled config is cached next
+        to the config file and reused as long as the config has not changed.
         """
-        with open(self.config) as json_file:
-            data = json.load(json_file)
+        # taken before reading so an edit made during setup is not cached as current
+        cache_key = self.cache_key()
+        if self.load_cache(cache_key):
+            return
+        with open(self.config, "rb") as json_file:
+            raw_config = json_file.read()
+        data = json.loads(raw_config)
+        # changes whenever the config does so cached decisions can be dropped
+        self.config_hash = hashlib.sha1(raw_config).hexdigest()
         # setting setup
         self.settings = data["settings"]
 
         # default watcher folder
         self.watched_folder = self.settings["watched_folder"]
 
+        # More folders cleaned by the same process. Each one is a path or a dict with a
+        # path and any of rename, recursive, file_group_dest, special_case_dest and
+        # keywords_dest to override for that folder. Replaces watched_folder when set.
+        self.watched_folders = self.settings.get("watched_folders", [])
+
         # Enables asking to delete files that match a filename from delete_def.
         self.ask_to_delete = self.settings["ask_to_delete"]
 
@@ -38,6 +79,79 @@ class Config:
         # True sets progress bar to use ascii in case of unicode issues.
         self.ascii = self.settings["ascii_bar"]
 
+        # Plays a sound when the clean is done on platforms that have one.
+        self.completion_sound = self.settings.get("completion_sound", True)
+
+        # Max number of moves that can run at once for each destination drive.
+        self.workers_per_device = self.settings.get("workers_per_device", 2)
+
+        # Copies of files at least this many bytes go in their own lane so small files never wait behind them.
+        self.large_file_size = self.settings.get("large_file_size", 100_000_000)
+
+        # Max bytes per second copied to each destination drive, 0 for no limit.
+        # device_bandwidth_limits sets the limit of the drive holding each listed path.
+        self.bandwidth_limit = self.settings.get("bandwidth_limit", 0)
+        self.device_bandwidth_limits = self.settings.get("device_bandwidth_limits", {})
+
+        # Runs with idle disk priority and lower CPU priority so other programs go first.
+        self.low_io_priority = self.settings.get("low_io_priority", False)
+
+        # Remembers files that were left in place so rescans skip them until they change.
+        self.incremental_scan = self.settings.get("incremental_scan", False)
+        self.scan_index_path = self.settings.get("scan_index_path", "scan_index.json")
+
+        # What to do when a file with the same name is already at the destination.
+        # skip leaves it in place, suffix adds a number and newer overwrites older files.
+        self.collision_policy = self.settings.get("collision_policy", "skip")
+
+        # Also cleans subfolders of the watched folder and prunes the ones left empty.
+        self.recursive = self.settings.get("recursive", False)
+
+        # Streams files from the scan straight to the movers instead of sorting them by size first.
+        self.streaming = self.settings.get("streaming", False)
+        self.max_in_flight = self.settings.get("max_in_flight", 1000)
+
+        # Watch mode poll interval and how long a file must stay unchanged before it is moved.
+        self.watch_interval = self.settings.get("watch_interval", 2)
+        self.settle_seconds = self.settings.get("settle_seconds", 5)
+
+        # Files still being downloaded are never moved in watch mode.
+        self.partial_suffixes = self.settings.get(
+            "partial_suffixes", [".part", ".crdownload", ".download", ".tmp"]
+        )
+
+        # Reads the header of files whose extension matches no rule to find their real type.
+        self.sniff_content = self.settings.get("sniff_content", False)
+        self.sniff_cache_path = self.settings.get("sniff_cache_path", "sniff_cache.json")
+
+        # What to do with files whose content is already in their destination folder.
+        # off moves them anyway, skip leaves them in place, hardlink links the existing copy
+        # under the new name and delete removes them. Streaming runs are not checked.
+        self.duplicate_action = self.settings.get("duplicate_action", "off")
+        if self.duplicate_action != "off":
+            # only loaded when duplicates are handled so startup stays fast
+            from utils.dedupe import DUPLICATE_ACTIONS
+
+            if self.duplicate_action not in DUPLICATE_ACTIONS:
+                raise ValueError(f"Unknown duplicate_action {self.duplicate_action}")
+        self.hash_cache_path = self.settings.get("hash_cache_path", "hash_cache.json")
+        self.hash_workers = self.settings.get("hash_workers", 4)
+
+        # Records every move in an append-only journal so interrupted runs are finished
+        # or rolled back on the next start and runs can be undone.
+        self.journal = self.settings.get("journal", False)
+        self.journal_path = self.settings.get("journal_path", "journal.jsonl")
+
+        # move relocates files. reflink and hardlink leave them in the watched folder and
+        # place a clone or hard link at the destination, copying only across drives.
+        self.organize_mode = self.settings.get("organize_mode", "move")
+        if self.organize_mode not in ORGANIZE_MODES:
+            raise ValueError(f"Unknown organize_mode {self.organize_mode}")
+
+        # Writes a row for every moved file to this .csv or .jsonl file as the run goes
+        # and shows the end of run manifest from it. Empty to keep no manifest.
+        self.manifest_path = self.settings.get("manifest_path", "")
+
         # Sets file types into groups.
         self.file_type_groups = data["file_type_groups"]
 
@@ -53,8 +167,120 @@ class Config:
         # Lists files to possible delete instead of moving.
         self.delete_def = data["delete_def"]
 
-        # loads the rename presets
+        # Age, mtime and size rules that hold files until they are old enough to move or delete.
+        self.retention = RetentionRules(data.get("retention_rules", []))
+
+        # Subfolder templates and size limits that keep large destination folders small.
+        self.sharding = ShardRules(data.get("destination_sharding", {}))
+
+        # loads the rename presets and compiles them into a single pass
         self.file_rename_presets = data["file_rename"]
+        self.renamer = Renamer(self.file_rename_presets)
+
+        # compiles the routing rules so files can be classified in one pass
+        self.rules = RuleIndex(
+            self.file_type_groups,
+            self.file_group_dest,
+            self.special_case_dest,
+            self.keywords_dest,
+        )
+        self.folders = [
+            self.make_folder(folder)
+            for folder in self.watched_folders or [self.watched_folder]
+        ]
+        self.watched_folder = self.folders[0].path
+        self.save_cache(cache_key)
+
+    def make_folder(self, folder):
+        """
+        Returns a WatchedFolder for an entry of watched_folders, compiling its own rule
+        index only if it overrides any destinations.
+        """
+        if type(folder) == str:
+            folder = {"path": folder}
+        rules = self.rules
+        dest_dicts = [self.file_group_dest, self.special_case_dest, self.keywords_dest]
+        if any(name in folder for name in RULE_OVERRIDES):
+            dest_dicts = [
+                {**base, **folder.get(name, {})}
+                for name, base in zip(RULE_OVERRIDES, dest_dicts)
+            ]
+            file_group_dest, special_case_dest, keywords_dest = dest_dicts
+            rules = RuleIndex(
+                self.file_type_groups, file_group_dest, special_case_dest, keywords_dest
+            )
+        return WatchedFolder(
+            folder["path"],
+            rules,
+            folder.get("rename", self.rename),
+            folder.get("recursive", self.recursive),
+            destinations_of(dest_dicts),
+        )
+
+    def cache_path(self):
+        return self.config.with_name(f"{self.config.name}.cache")
+
+    def cache_key(self):
+        """
+        Returns a key that changes whenever the config file is edited.
+        """
+        stat = self.config.stat()
+        return (CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+
+    def load_cache(self, cache_key) -> bool:
+        """
+        Loads the compiled config from the cache and returns True if it is up to date.
+        """
+        try:
+            with open(self.cache_path(), "rb") as cache_file:
+                key, state = pickle.load(cache_file)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, ImportError):
+            return False
+        if key != cache_key:
+            return False
+        self.__dict__.update(state)
+        return True
+
+    def save_cache(self, cache_key) -> None:
+        """
+        Saves the compiled config so the next launch can skip parsing and compiling it.
+        """
+        state = {name: value for name, value in vars(self).items() if name != "config"}
+        temp_path = f"{self.cache_path()}.tmp"
+        try:
+            with open(temp_path, "wb") as cache_file:
+                pickle.dump((cache_key, state), cache_file)
+            os.replace(temp_path, self.cache_path())
+        except OSError:
+            # a read only config folder just means no cache
+            pass
+
+    def folder_paths(self):
+        return [folder.path for folder in self.folders]
+
+    def all_destinations(self):
+        """
+        Returns every destination folder set in the config, including folder overrides.
+        """
+        destinations = set()
+        for folder in self.folders:
+            destinations |= folder.destinations
+        return destinations
+
+
+def destinations_of(dest_dicts):
+    """
+    Returns the destination folders in file_group_dest, special_case_dest and keywords_dest style dicts.
+    """
+    destinations = set()
+    for dirs in dest_dicts:
+        for dest in dirs.values():
+            if type(dest) == list:
+                dest = dest[1]
+            if dest != "skip":
+                destinations.add(dest)
+    return destinations
+
 
 if __name__ == "__main__":
     config = Config()
@@ -0,0 +1,36 @@
+import sys
+
+# rich console theme
+THEME = {
+    "primary": "bold deep_sky_blue1",
+    "secondary": "bold pale_turquoise1",
+    # error
+    "info": "dim cyan",
+    "warning": "bold magenta",
+    "danger": "bold red",
+}
+
+
+class PlainConsole:
+    """
+    Prints without styles. Used when output is not a terminal, such as cron jobs
+    and file manager hooks, so rich is never imported.
+    """
+
+    @staticmethod
+    def print(msg="", style=None) -> None:
+        print(msg)
+
+
+def get_console():
+    """
+    Returns a rich console when writing to a terminal and a PlainConsole otherwise.
+    """
+    if not sys.stdout.isatty():
+        return PlainConsole()
+    try:
+        from rich.console import Console
+        from rich.theme import Theme
+    except ModuleNotFoundError:
+        return PlainConsole()
+    return Console(theme=Theme(THEME))
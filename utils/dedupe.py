@@ -0,0 +1,211 @@
+import concurrent.futures, threading, hashlib, json, os
+
+# bytes hashed from each end of a file before committing to a full hash
+BLOCK_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+# least recently used hashes are dropped past this many files
+MAX_CACHE_ENTRIES = 100000
+
+DUPLICATE_ACTIONS = ["off", "skip", "hardlink", "delete"]
+
+
+def same_file(path, other) -> bool:
+    """
+    Returns True if both paths are the same file, such as a hard link to it.
+    """
+    try:
+        return os.path.samefile(path, other)
+    except OSError:
+        return False
+
+
+def partial_hash(path, size) -> str:
+    """
+    Hashes the first and last BLOCK_SIZE bytes of a file.
+    Files no larger than two blocks are hashed whole.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(BLOCK_SIZE))
+        if size > BLOCK_SIZE:
+            f.seek(max(size - BLOCK_SIZE, BLOCK_SIZE))
+            digest.update(f.read(BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def full_hash(path) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """
+    On disk record of partial and full hashes keyed by (device, inode, size, mtime).
+    Files moved by a rename keep their key so a hashed download is not hashed
+    again once it sits in a destination folder.
+    """
+
+    def __init__(self, path=None) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        if path:
+            try:
+                with open(path) as json_file:
+                    self.entries = json.load(json_file)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    @staticmethod
+    def key(stat) -> str:
+        return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def get(self, key, kind):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            # moved to the end so the oldest entries are dropped first
+            self.entries[key] = entry
+            return entry.get(kind)
+
+    def put(self, key, kind, value) -> None:
+        with self.lock:
+            self.entries.setdefault(key, {})[kind] = value
+            self.changed = True
+
+    def save(self) -> None:
+        if not self.path or not self.changed:
+            return
+        with self.lock:
+            while len(self.entries) > MAX_CACHE_ENTRIES:
+                del self.entries[next(iter(self.entries))]
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, "w") as json_file:
+                json.dump(self.entries, json_file, separators=(",", ":"))
+            os.replace(temp_path, self.path)
+            self.changed = False
+
+
+class Deduper:
+    """
+    Finds move_queue entries whose content already exists in their destination folder.
+
+    Files are compared in stages so most are never read: only sizes shared with a
+    destination file are hashed, the first and last blocks are hashed before the
+    whole file, and only files whose partial hashes match are hashed in full.
+    Hashing runs in a thread pool since hashlib releases the GIL while hashing.
+    """
+
+    def __init__(self, cache_path=None, workers=4) -> None:
+        self.cache = HashCache(cache_path)
+        self.workers = workers
+        self.files_hashed = 0
+
+    def hash(self, path, kind):
+        """
+        Returns the partial or full hash of `path` or None if it can not be read.
+        """
+        try:
+            stat = os.stat(path)
+            key = self.cache.key(stat)
+            value = self.cache.get(key, kind)
+            if value is None:
+                if kind == "partial":
+                    value = partial_hash(path, stat.st_size)
+                else:
+                    value = full_hash(path)
+                self.cache.put(key, kind, value)
+                self.files_hashed += 1
+        except OSError:
+            return None
+        return value
+
+    def hash_all(self, paths, kind):
+        """
+        Returns a dict of path to hash for all `paths` hashed in the thread pool.
+        """
+        paths = list(dict.fromkeys(paths))
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            return dict(zip(paths, pool.map(lambda path: self.hash(path, kind), paths)))
+
+    @staticmethod
+    def destination_sizes(destinations):
+        """
+        Returns a dict of (destination, size) to the files of that size in each destination.
+        """
+        sizes = {}
+        for destination in destinations:
+            try:
+                with os.scandir(destination) as files:
+                    for file in files:
+                        if file.is_file(follow_symlinks=False):
+                            key = (destination, file.stat().st_size)
+                            sizes.setdefault(key, []).append(file.path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return sizes
+
+    def find(self, entries):
+        """
+        Returns a list of (entry, existing path) for each entry that is a duplicate
+        of a file already in its destination folder.
+        """
+        sizes = self.destination_sizes({entry["destination"] for entry in entries})
+        # stage one: only files whose size matches a destination file go on
+        candidates = [
+            entry
+            for entry in entries
+            if entry["file_size"] > 0
+            and (entry["destination"], entry["file_size"]) in sizes
+        ]
+        if not candidates:
+            return []
+        # stage two: first and last blocks
+        paths = [entry["target"] for entry in candidates]
+        for entry in candidates:
+            paths += sizes[(entry["destination"], entry["file_size"])]
+        partials = self.hash_all(paths, "partial")
+        matches = []
+        for entry in candidates:
+            partial = partials.get(entry["target"])
+            # a hard link to the file itself, as organize mode places, is not a copy of it
+            existing = [
+                path
+                for path in sizes[(entry["destination"], entry["file_size"])]
+                if partial
+                and partials.get(path) == partial
+                and not same_file(entry["target"], path)
+            ]
+            if existing:
+                matches.append((entry, existing))
+        # stage three: full hashes, which the partial hash already is for small files
+        large = [entry for entry, existing in matches if entry["file_size"] > BLOCK_SIZE * 2]
+        paths = [entry["target"] for entry in large]
+        for entry, existing in matches:
+            if entry["file_size"] > BLOCK_SIZE * 2:
+                paths += existing
+        fulls = self.hash_all(paths, "full")
+        duplicates = []
+        for entry, existing in matches:
+            if entry["file_size"] > BLOCK_SIZE * 2:
+                full = fulls.get(entry["target"])
+                existing = [path for path in existing if full and fulls.get(path) == full]
+            if existing:
+                duplicates.append((entry, existing[0]))
+        self.cache.save()
+        return duplicates
+
+
+def link_duplicate(original, destination, source) -> str:
+    """
+    Hard links `original` to `destination` and removes `source`, which has the same content.
+    Raises OSError when they are on different filesystems.
+    """
+    os.link(original, destination)
+    os.remove(source)
+    return "hardlink"
@@ -0,0 +1,139 @@
+import threading, os
+
+from utils.filesystem import OSFileSystem
+
+COLLISION_POLICIES = ["skip", "suffix", "newer"]
+
+
+class DestinationIndex:
+    """
+    In memory listing of destination folders so collision checks are set lookups.
+
+    Each folder is listed once the first time it is needed and then kept up to date
+    as files are moved into it, so no per file stat calls hit the destination disk.
+    """
+
+    def __init__(self, policy="skip", fs=None) -> None:
+        """
+        Keyword arguments:
+
+        policy -- what to do when a name is taken, one of COLLISION_POLICIES
+
+        fs -- filesystem backend from utils.filesystem, defaults to the real OS
+        """
+        if policy not in COLLISION_POLICIES:
+            raise ValueError(f"Unknown collision policy {policy}")
+        self.policy = policy
+        self.fs = fs or OSFileSystem()
+        # folder -> set of names or None if the folder does not exist yet
+        self.folders = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(name):
+        return os.path.normcase(name)
+
+    def names(self, folder):
+        """
+        Returns the set of names in `folder`, listing it on first use.
+        """
+        with self.lock:
+            folder = os.path.normpath(folder)
+            if folder not in self.folders:
+                try:
+                    with self.fs.scandir(folder) as entries:
+                        self.folders[folder] = {self.key(entry.name) for entry in entries}
+                except FileNotFoundError:
+                    self.folders[folder] = None
+            return self.folders[folder]
+
+    def folder_exists(self, folder) -> bool:
+        return self.names(folder) is not None
+
+    def folder_created(self, folder) -> None:
+        """
+        Records that `folder` was created empty.
+        """
+        with self.lock:
+            self.folders[os.path.normpath(folder)] = set()
+
+    def forget(self, folder) -> None:
+        """
+        Drops what is known about `folder` so it is listed again on next use.
+        """
+        with self.lock:
+            self.folders.pop(os.path.normpath(folder), None)
+
+    def contains(self, folder, name) -> bool:
+        names = self.names(folder)
+        return names is not None and self.key(name) in names
+
+    def add(self, folder, name) -> None:
+        """
+        Records a file landing in `folder`. Missing folders are recorded as created.
+        """
+        with self.lock:
+            if self.names(folder) is None:
+                self.folder_created(folder)
+            self.folders[os.path.normpath(folder)].add(self.key(name))
+
+    def discard(self, folder, name) -> None:
+        with self.lock:
+            names = self.names(folder)
+            if names is not None:
+                names.discard(self.key(name))
+
+    def is_placed(self, folder, name, source_stat) -> bool:
+        """
+        Returns True if `name` in `folder` is already the file with `source_stat`, either
+        as a hard link to it or as a clone or copy with the same size and mtime.
+        """
+        try:
+            existing = self.fs.stat(os.path.join(folder, name))
+        except FileNotFoundError:
+            return False
+        if (existing.st_ino, existing.st_dev) == (source_stat.st_ino, source_stat.st_dev):
+            return True
+        return (existing.st_size, existing.st_mtime_ns) == (
+            source_stat.st_size,
+            source_stat.st_mtime_ns,
+        )
+
+    def resolve(self, folder, name, source=None, keep_source=False):
+        """
+        Applies the collision policy to `name` in `folder` and returns a tuple of
+        (name to use or None to skip, True if an existing file should be overwritten).
+
+        Keyword arguments:
+
+        source -- path of the incoming file, used by the newer policy
+
+        keep_source -- the source stays where it is, as in organize mode, so a name
+        already holding the same file is skipped instead of placing it again
+        """
+        with self.lock:
+            if not self.contains(folder, name):
+                return name, False
+            source_stat = None
+            if keep_source and source is not None:
+                source_stat = self.fs.stat(source)
+                if self.is_placed(folder, name, source_stat):
+                    return None, False
+            if self.policy == "suffix":
+                stem, ext = os.path.splitext(name)
+                count = 1
+                while self.contains(folder, f"{stem} ({count}){ext}"):
+                    if source_stat and self.is_placed(
+                        folder, f"{stem} ({count}){ext}", source_stat
+                    ):
+                        return None, False
+                    count += 1
+                return f"{stem} ({count}){ext}", False
+            if self.policy == "newer" and source is not None:
+                try:
+                    existing = self.fs.stat(os.path.join(folder, name)).st_mtime
+                except FileNotFoundError:
+                    return name, False
+                if self.fs.stat(source).st_mtime > existing:
+                    return name, True
+            return None, False
@@ -0,0 +1,403 @@
+import threading, itertools, stat, time, os
+from collections import Counter
+
+from utils.transfer import transfer, link_file, device_id, TransferCancelled, CHUNK_SIZE
+
+
+class OSFileSystem:
+    """
+    Filesystem backend used by default, which passes every call to the real OS.
+    """
+
+    # calls are counted by Metrics.count_syscalls instead
+    simulated = False
+
+    def scandir(self, path):
+        return os.scandir(path)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def exists(self, path) -> bool:
+        return os.path.exists(path)
+
+    def mkdir(self, path) -> None:
+        os.mkdir(path)
+
+    def remove(self, path) -> None:
+        os.remove(path)
+
+    def rmdir(self, path) -> None:
+        os.rmdir(path)
+
+    def device_id(self, path):
+        return device_id(path)
+
+    def move(
+        self, source, destination, cancel=None, overwrite=False, limiter=None, on_chunk=None
+    ) -> str:
+        """
+        Moves a file with utils.transfer.transfer and returns how it was done.
+        """
+        return transfer(
+            source,
+            destination,
+            cancel,
+            overwrite=overwrite,
+            limiter=limiter,
+            on_chunk=on_chunk,
+        )
+
+    def link(
+        self,
+        source,
+        destination,
+        mode="reflink",
+        cancel=None,
+        overwrite=False,
+        limiter=None,
+        on_chunk=None,
+    ) -> str:
+        """
+        Places a file without removing it with utils.transfer.link_file and returns the method.
+        """
+        return link_file(
+            source,
+            destination,
+            cancel,
+            mode,
+            overwrite=overwrite,
+            limiter=limiter,
+            on_chunk=on_chunk,
+        )
+
+
+class MemoryStat:
+    """
+    The parts of os.stat_result the cleaner reads.
+    """
+
+    __slots__ = ("st_mode", "st_size", "st_mtime_ns", "st_ino", "st_dev")
+
+    def __init__(self, st_mode, st_size, st_mtime_ns, st_ino, st_dev) -> None:
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ino = st_ino
+        self.st_dev = st_dev
+
+    @property
+    def st_mtime(self) -> float:
+        return self.st_mtime_ns / 1e9
+
+
+class MemoryDirEntry:
+    """
+    Stands in for os.DirEntry. Like the real one its type comes with the listing
+    and stat is only looked up, and counted, the first time it is called.
+    """
+
+    __slots__ = ("fs", "name", "path", "is_folder", "_stat")
+
+    def __init__(self, fs, name, path, is_folder) -> None:
+        self.fs = fs
+        self.name = name
+        self.path = path
+        self.is_folder = is_folder
+        self._stat = None
+
+    def is_dir(self, follow_symlinks=True) -> bool:
+        return self.is_folder
+
+    def is_file(self, follow_symlinks=True) -> bool:
+        return not self.is_folder
+
+    def stat(self, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = self.fs.stat(self.path)
+        return self._stat
+
+
+class MemoryListing(list):
+    """
+    Result of MemoryFileSystem.scandir, usable in a with block like os.scandir.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryFileSystem:
+    """
+    Filesystem backend that keeps folders and file sizes in memory so the rule engine,
+    move scheduler and collision handling can be run on millions of files in seconds.
+    Files have a size and mtime but no content, so content sniffing, duplicate hashing
+    and the journal, which read real files, still need the OS backend.
+
+    Every call is counted in `calls` and can be slowed down to simulate a disk.
+
+    Keyword arguments:
+
+    latency -- seconds each call takes, or a dict of call name to seconds
+
+    devices -- dict of folder to device id, files outside all of them are on device 0.
+    Moves between devices are simulated copies.
+
+    copy_rate -- bytes per second of a simulated copy, None for no delay
+    """
+
+    simulated = True
+
+    def __init__(self, latency=0.0, devices=None, copy_rate=None) -> None:
+        self.latency = latency
+        self.devices = {os.path.normpath(path): dev for path, dev in (devices or {}).items()}
+        self.copy_rate = copy_rate
+        self.device_cache = {}
+        # folder -> dict of names in it, True for folders and False for files
+        self.folders = {}
+        # file path -> MemoryStat
+        self.files = {}
+        self.calls = Counter()
+        self.inodes = itertools.count(1)
+        self.lock = threading.RLock()
+
+    def call(self, name) -> None:
+        """
+        Counts a call and waits for its simulated latency.
+        """
+        with self.lock:
+            self.calls[name] += 1
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, 0.0)
+        if latency:
+            time.sleep(latency)
+
+    @staticmethod
+    def norm(path) -> str:
+        return os.path.normpath(path)
+
+    def add_folder(self, path) -> None:
+        """
+        Creates a folder and any missing parents without counting calls.
+        """
+        path = self.norm(path)
+        missing = []
+        with self.lock:
+            while path not in self.folders:
+                missing.append(path)
+                parent = os.path.dirname(path)
+                if not parent or parent == path:
+                    break
+                path = parent
+            for folder in reversed(missing):
+                self.folders[folder] = {}
+                parent = os.path.dirname(folder)
+                if parent in self.folders and parent != folder:
+                    self.folders[parent][os.path.basename(folder)] = True
+
+    def add_file(self, path, size=0, mtime=None) -> None:
+        """
+        Creates a file of `size` bytes and any missing parent folders without counting calls.
+
+        mtime -- modification time in seconds, defaults to now
+        """
+        path = self.norm(path)
+        mtime = time.time() if mtime is None else mtime
+        self.add_folder(os.path.dirname(path) or ".")
+        self.place(path, size, int(mtime * 1e9))
+
+    def place(self, path, size, mtime_ns, inode=None) -> None:
+        """
+        Puts a file in its existing parent folder, as a new inode unless one is given.
+        """
+        with self.lock:
+            self.folders[os.path.dirname(path) or "."][os.path.basename(path)] = False
+            self.files[path] = MemoryStat(
+                stat.S_IFREG,
+                size,
+                mtime_ns,
+                next(self.inodes) if inode is None else inode,
+                self.device_of(os.path.dirname(path) or "."),
+            )
+
+    def device_of(self, path) -> int:
+        """
+        Returns the device of the deepest folder in `devices` containing `path`.
+        Answers are cached by folder since devices do not change.
+        """
+        path = self.norm(path)
+        if path in self.device_cache:
+            return self.device_cache[path]
+        if path in self.devices:
+            device = self.devices[path]
+        else:
+            parent = os.path.dirname(path)
+            device = 0 if not parent or parent == path else self.device_of(parent)
+        self.device_cache[path] = device
+        return device
+
+    def scandir(self, path):
+        self.call("scandir")
+        folder = self.norm(path)
+        with self.lock:
+            if folder not in self.folders:
+                raise FileNotFoundError(path)
+            names = list(self.folders[folder].items())
+        return MemoryListing(
+            MemoryDirEntry(self, name, os.path.join(path, name), is_folder)
+            for name, is_folder in names
+        )
+
+    def stat(self, path):
+        self.call("stat")
+        path = self.norm(path)
+        with self.lock:
+            if path in self.files:
+                return self.files[path]
+            if path in self.folders:
+                return MemoryStat(stat.S_IFDIR, 0, 0, 0, self.device_of(path))
+        raise FileNotFoundError(path)
+
+    def exists(self, path) -> bool:
+        self.call("stat")
+        path = self.norm(path)
+        with self.lock:
+            return path in self.files or path in self.folders
+
+    def mkdir(self, path) -> None:
+        self.call("mkdir")
+        path = self.norm(path)
+        parent = os.path.dirname(path) or "."
+        with self.lock:
+            if path in self.folders or path in self.files:
+                raise FileExistsError(path)
+            if parent not in self.folders:
+                raise FileNotFoundError(path)
+            self.folders[path] = {}
+            self.folders[parent][os.path.basename(path)] = True
+
+    def remove(self, path) -> None:
+        self.call("remove")
+        path = self.norm(path)
+        with self.lock:
+            if path not in self.files:
+                raise FileNotFoundError(path)
+            del self.files[path]
+            del self.folders[os.path.dirname(path) or "."][os.path.basename(path)]
+
+    def rmdir(self, path) -> None:
+        self.call("rmdir")
+        path = self.norm(path)
+        with self.lock:
+            if path not in self.folders:
+                raise FileNotFoundError(path)
+            if self.folders[path]:
+                raise OSError(f"Directory not empty: {path}")
+            del self.folders[path]
+            parent = os.path.dirname(path)
+            if parent in self.folders:
+                del self.folders[parent][os.path.basename(path)]
+
+    def device_id(self, path):
+        return self.device_of(path)
+
+    def check_target(self, source, destination, overwrite):
+        """
+        Returns (stat of source, normalized source, normalized destination) after the
+        checks transfer makes, or None for the stat if both are the same file.
+        """
+        source_stat = self.stat(source)
+        if self.norm(destination) in self.folders:
+            destination = os.path.join(destination, os.path.basename(source))
+        source, destination = self.norm(source), self.norm(destination)
+        if source == destination:
+            return None, source, destination
+        if not overwrite and self.exists(destination):
+            raise FileExistsError(destination)
+        if (os.path.dirname(destination) or ".") not in self.folders:
+            raise FileNotFoundError(destination)
+        return source_stat, source, destination
+
+    def copy_chunks(self, source, size, cancel, limiter, on_chunk) -> None:
+        """
+        Simulates the chunks of a copy between devices.
+        """
+        offset = 0
+        while offset < size:
+            if cancel is not None and cancel.is_set():
+                raise TransferCancelled(source)
+            copied = min(CHUNK_SIZE, size - offset)
+            self.call("copy_file_range")
+            if self.copy_rate:
+                time.sleep(copied / self.copy_rate)
+            offset += copied
+            if on_chunk is not None:
+                on_chunk(copied)
+            if limiter is not None:
+                limiter.consume(copied, cancel)
+
+    def move(
+        self, source, destination, cancel=None, overwrite=False, limiter=None, on_chunk=None
+    ) -> str:
+        """
+        Moves a file the way utils.transfer.transfer does, as a rename within a device
+        and as a chunked copy that can be limited and cancelled between devices.
+        """
+        source_stat, source, destination = self.check_target(source, destination, overwrite)
+        if source_stat is None:
+            return "skip"
+        method = "rename"
+        if source_stat.st_dev != self.device_of(os.path.dirname(destination) or "."):
+            method = "copy"
+            self.copy_chunks(source, source_stat.st_size, cancel, limiter, on_chunk)
+        else:
+            self.call("replace")
+        with self.lock:
+            self.files.pop(destination, None)
+            del self.files[source]
+            del self.folders[os.path.dirname(source) or "."][os.path.basename(source)]
+            # a rename keeps the inode and a copy gets a new one with the same mtime
+            inode = source_stat.st_ino if method == "rename" else None
+            self.place(destination, source_stat.st_size, source_stat.st_mtime_ns, inode)
+        if method == "copy":
+            self.call("remove")
+        return method
+
+    def link(
+        self,
+        source,
+        destination,
+        mode="reflink",
+        cancel=None,
+        overwrite=False,
+        limiter=None,
+        on_chunk=None,
+    ) -> str:
+        """
+        Places a file without removing it the way utils.transfer.link_file does. Every
+        simulated device supports reflinks, which get a new inode, and hard links share one.
+        """
+        source_stat, source, destination = self.check_target(source, destination, overwrite)
+        if source_stat is None:
+            return "skip"
+        inode = None
+        if source_stat.st_dev != self.device_of(os.path.dirname(destination) or "."):
+            method = "copy"
+            self.copy_chunks(source, source_stat.st_size, cancel, limiter, on_chunk)
+        elif mode == "reflink":
+            method = "reflink"
+            self.call("ioctl")
+        else:
+            method = "hardlink"
+            inode = source_stat.st_ino
+            self.call("link")
+        with self.lock:
+            self.place(destination, source_stat.st_size, source_stat.st_mtime_ns, inode)
+        return method
@@ -0,0 +1,223 @@
+import threading, glob, json, time, os
+
+# runs kept when the journal is compacted
+KEEP_RUNS = 20
+
+
+class Journal:
+    """
+    Append-only record of every move as JSON lines so a crashed run can be finished
+    or rolled back and a whole run can be undone without searching the filesystem.
+
+    A move is written as planned before the file is touched and as done afterwards.
+    Records are written by a single thread that fsyncs everything queued since its
+    last write at once, so moves running in parallel share one fsync. Only planned
+    records are waited on, done records are committed with the next batch.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.run_id = None
+        self.file = None
+        self.condition = threading.Condition()
+        self.pending = []
+        self.sequence = 0
+        self.durable = 0
+        self.move_ids = 0
+        self.closing = False
+        self.thread = None
+        self.commits = 0
+
+    def open(self) -> None:
+        """
+        Starts a new run and the writer thread.
+        """
+        now = time.time_ns()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now // 10**9))
+        # nanoseconds keep watch mode batches started in the same second apart
+        self.run_id = f"{stamp}.{now % 10**9:09d}-{os.getpid()}"
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.closing = False
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+        self.append({"op": "begin", "time": time.time()}, wait=True)
+
+    def close(self) -> None:
+        """
+        Ends the run and waits for every record to be written.
+        """
+        if self.file is None:
+            return
+        self.append({"op": "end", "time": time.time()})
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.file.close()
+        self.file = None
+
+    def append(self, record, wait=False) -> None:
+        """
+        Queues a record for the current run. With `wait` it returns once the record is on disk.
+        """
+        record.setdefault("run", self.run_id)
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.condition:
+            self.sequence += 1
+            sequence = self.sequence
+            self.pending.append(line)
+            self.condition.notify_all()
+            while wait and self.durable < sequence:
+                self.condition.wait()
+
+    def writer(self) -> None:
+        """
+        Writes and fsyncs queued records in batches until the journal is closed.
+        """
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                lines = self.pending
+                self.pending = []
+                sequence = self.sequence
+            self.file.write("".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            with self.condition:
+                self.durable = sequence
+                self.commits += 1
+                self.condition.notify_all()
+
+    def plan_move(self, source, destination, overwrite=False, keep_source=False) -> int:
+        """
+        Records a move before it starts and returns its id once the record is on disk.
+        keep_source marks a file placed by organize mode, whose source stays where it is.
+        """
+        with self.condition:
+            self.move_ids += 1
+            move_id = self.move_ids
+        record = {"op": "plan", "id": move_id, "src": source, "dst": destination}
+        if overwrite:
+            record["overwrite"] = True
+        if keep_source:
+            record["keep"] = True
+        self.append(record, wait=True)
+        return move_id
+
+    def finish_move(self, move_id, method) -> None:
+        self.append({"op": "done", "id": move_id, "method": method})
+
+    def fail_move(self, move_id) -> None:
+        self.append({"op": "failed", "id": move_id})
+
+
+def read_runs(path):
+    """
+    Returns a dict of run id to its moves, whether it ended or was recovered, whether it
+    was undone and which run it undid if it was an undo run. Each move is its planned
+    record with a "state" of plan, done or failed. A line cut off by a crash is ignored.
+    """
+    runs = {}
+    try:
+        journal_file = open(path, encoding="utf-8")
+    except FileNotFoundError:
+        return runs
+    with journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            run = runs.setdefault(record["run"], new_run())
+            op = record["op"]
+            if op == "plan":
+                record["state"] = "plan"
+                run["moves"][record["id"]] = record
+            elif op in ["done", "failed"] and record["id"] in run["moves"]:
+                run["moves"][record["id"]]["state"] = op
+                run["moves"][record["id"]]["method"] = record.get("method")
+            elif op in ["end", "recovered"]:
+                run["ended"] = True
+            elif op == "undo":
+                run["undo_of"] = record["target"]
+                runs.setdefault(record["target"], new_run())["undone"] = True
+    return runs
+
+
+def new_run():
+    return {"moves": {}, "ended": False, "undone": False, "undo_of": None}
+
+
+def remove_partials(destination) -> None:
+    """
+    Removes temp files left by a chunked copy to `destination` that was cut off.
+    """
+    directory, name = os.path.split(destination)
+    pattern = os.path.join(glob.escape(directory), f".{glob.escape(name)}.*.part")
+    for path in glob.glob(pattern):
+        os.remove(path)
+
+
+def same_file(source, destination) -> bool:
+    """
+    Returns True if both paths hold a file of the same size and mtime, as a finished copy does.
+    """
+    source_stat = os.stat(source)
+    destination_stat = os.stat(destination)
+    return (
+        source_stat.st_size == destination_stat.st_size
+        and source_stat.st_mtime_ns == destination_stat.st_mtime_ns
+    )
+
+
+def recover_move(move) -> str:
+    """
+    Finishes or rolls back a move that was planned but never recorded as done and
+    returns done, rolled_back or missing.
+    """
+    source, destination = move["src"], move["dst"]
+    source_exists = os.path.exists(source)
+    destination_exists = os.path.exists(destination)
+    remove_partials(destination)
+    if move.get("keep"):
+        # organize mode never removes the source so only the placed copy matters
+        if destination_exists:
+            return "done"
+        return "rolled_back" if source_exists else "missing"
+    if source_exists and destination_exists:
+        if same_file(source, destination):
+            # copied into place but the source was not removed yet
+            os.remove(source)
+            return "done"
+        return "rolled_back"
+    if destination_exists:
+        return "done"
+    if source_exists:
+        return "rolled_back"
+    return "missing"
+
+
+def compact(path, runs) -> None:
+    """
+    Rewrites the journal with only the last KEEP_RUNS runs.
+    """
+    if len(runs) <= KEEP_RUNS:
+        return
+    keep = set(list(runs)[-KEEP_RUNS:])
+    temp_path = f"{path}.tmp"
+    with open(path, encoding="utf-8") as journal_file, open(
+        temp_path, "w", encoding="utf-8"
+    ) as temp_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record["run"] in keep:
+                temp_file.write(line)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_path, path)
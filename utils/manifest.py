@@ -0,0 +1,70 @@
+import threading, json, time, csv
+
+FIELDS = ["time", "source", "destination", "file_size", "method"]
+
+
+class Manifest:
+    """
+    Writes a row for every file as it is moved or skipped so the report of a run is on
+    disk instead of in memory. Paths ending in .csv are written as CSV and anything else
+    as JSON lines. Safe to call from several move workers at once.
+
+    Keyword arguments:
+
+    append -- adds to an existing manifest instead of starting a new one, as watch mode does
+    """
+
+    def __init__(self, path, append=False) -> None:
+        self.path = path
+        self.is_csv = path.lower().endswith(".csv")
+        self.lock = threading.Lock()
+        self.rows = 0
+        # rows of files left in place because their name was taken
+        self.skipped = 0
+        new_file = True
+        if append:
+            try:
+                with open(path, "rb") as manifest_file:
+                    new_file = not manifest_file.read(1)
+            except FileNotFoundError:
+                pass
+        self.file = open(path, "a" if append else "w", newline="", encoding="utf-8")
+        if self.is_csv:
+            self.writer = csv.writer(self.file)
+            if new_file:
+                self.writer.writerow(FIELDS)
+
+    def record(self, source, destination, file_size, method) -> None:
+        row = [round(time.time(), 3), source, destination, file_size, method]
+        with self.lock:
+            if self.is_csv:
+                self.writer.writerow(row)
+            else:
+                self.file.write(json.dumps(dict(zip(FIELDS, row))) + "\n")
+            self.rows += 1
+            if method == "skip":
+                self.skipped += 1
+
+    def flush(self) -> None:
+        with self.lock:
+            self.file.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+def read_manifest(path):
+    """
+    Yields each row of a manifest as a dict one at a time so a large manifest can be
+    filtered without loading it.
+    """
+    with open(path, newline="", encoding="utf-8") as manifest_file:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(manifest_file):
+                row["time"] = float(row["time"])
+                row["file_size"] = int(row["file_size"]) if row["file_size"] else None
+                yield row
+        else:
+            for line in manifest_file:
+                yield json.loads(line)
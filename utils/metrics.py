@@ -0,0 +1,203 @@
+import contextlib, threading, bisect, json, time, os
+
+from utils.transfer import device_id
+
+# upper bounds in seconds for the per file move latency histogram
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300]
+
+# os functions counted while syscall counting is on
+COUNTED_CALLS = [
+    "stat",
+    "lstat",
+    "scandir",
+    "listdir",
+    "mkdir",
+    "rename",
+    "replace",
+    "remove",
+    "rmdir",
+    "open",
+]
+
+
+class Metrics:
+    """
+    Collects per phase wall time, counters, per device move throughput and a
+    histogram of per file move latency for a run.
+    """
+
+    def __init__(self, device_func=device_id) -> None:
+        """
+        Keyword arguments:
+
+        device_func -- returns the device of a folder, such as the device_id of a filesystem backend
+        """
+        self.device_func = device_func
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.syscalls = {}
+        # device -> {"files", "bytes", "busy", "start", "end"}
+        self.devices = {}
+        self.dest_devices = {}
+        self.methods = {}
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Times the code run inside the with block as phase `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds) -> None:
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_move(self, destination, file_size, start, end, method) -> None:
+        """
+        Records one finished move for the throughput and latency stats.
+
+        Keyword arguments:
+
+        start, end -- time.perf_counter values around the move
+
+        method -- transfer method returned by file_move
+        """
+        if destination not in self.dest_devices:
+            self.dest_devices[destination] = self.device_func(destination)
+        device = str(self.dest_devices[destination])
+        seconds = end - start
+        with self.lock:
+            stats = self.devices.setdefault(
+                device, {"files": 0, "bytes": 0, "busy": 0.0, "start": start, "end": end}
+            )
+            stats["files"] += 1
+            stats["bytes"] += file_size
+            stats["busy"] += seconds
+            stats["start"] = min(stats["start"], start)
+            stats["end"] = max(stats["end"], end)
+            self.methods[method] = self.methods.get(method, 0) + 1
+            self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.latency_sum += seconds
+
+    @contextlib.contextmanager
+    def count_syscalls(self):
+        """
+        Counts filesystem calls made through the os module inside the with block.
+        Calls made from C code, such as DirEntry.stat, are not seen.
+        """
+        originals = {name: getattr(os, name) for name in COUNTED_CALLS if hasattr(os, name)}
+
+        def counted(name, func):
+            def wrapper(*args, **kwargs):
+                with self.lock:
+                    self.syscalls[name] = self.syscalls.get(name, 0) + 1
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        for name, func in originals.items():
+            setattr(os, name, counted(name, func))
+        try:
+            yield
+        finally:
+            for name, func in originals.items():
+                setattr(os, name, func)
+
+    def report(self):
+        """
+        Returns all collected metrics as a dict.
+        """
+        with self.lock:
+            devices = {}
+            for device, stats in self.devices.items():
+                wall = max(stats["end"] - stats["start"], 1e-9)
+                devices[device] = {
+                    "files": stats["files"],
+                    "bytes": stats["bytes"],
+                    "seconds": round(wall, 6),
+                    "bytes_per_second": round(stats["bytes"] / wall, 1),
+                    "files_per_second": round(stats["files"] / wall, 1),
+                }
+            buckets = {}
+            total = 0
+            for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], self.latency_counts):
+                total += count
+                buckets[str(bound)] = total
+            return {
+                "started": self.started,
+                "phases": {name: round(value, 6) for name, value in self.phases.items()},
+                "counters": dict(self.counters),
+                "syscalls": dict(self.syscalls),
+                "devices": devices,
+                "transfer_methods": dict(self.methods),
+                "move_latency": {
+                    "buckets": buckets,
+                    "count": total,
+                    "sum": round(self.latency_sum, 6),
+                },
+            }
+
+    def write_json(self, path) -> None:
+        write_atomic(path, json.dumps(self.report(), indent=4))
+
+    def write_prometheus(self, path) -> None:
+        """
+        Writes the metrics in the Prometheus text format for the node exporter textfile collector.
+        """
+        report = self.report()
+        lines = [
+            "# TYPE folder_cleaner_phase_seconds gauge",
+            *[
+                f'folder_cleaner_phase_seconds{{phase="{name}"}} {value}'
+                for name, value in report["phases"].items()
+            ],
+            "# TYPE folder_cleaner_count gauge",
+            *[
+                f'folder_cleaner_count{{name="{name}"}} {value}'
+                for name, value in report["counters"].items()
+            ],
+            "# TYPE folder_cleaner_syscalls gauge",
+            *[
+                f'folder_cleaner_syscalls{{call="{name}"}} {value}'
+                for name, value in report["syscalls"].items()
+            ],
+            "# TYPE folder_cleaner_transfers gauge",
+            *[
+                f'folder_cleaner_transfers{{method="{name}"}} {value}'
+                for name, value in report["transfer_methods"].items()
+            ],
+        ]
+        for name in ["bytes_per_second", "files_per_second", "bytes", "files"]:
+            lines.append(f"# TYPE folder_cleaner_device_{name} gauge")
+            for device, stats in report["devices"].items():
+                lines.append(
+                    f'folder_cleaner_device_{name}{{device="{device}"}} {stats[name]}'
+                )
+        lines.append("# TYPE folder_cleaner_move_seconds histogram")
+        for bound, count in report["move_latency"]["buckets"].items():
+            lines.append(f'folder_cleaner_move_seconds_bucket{{le="{bound}"}} {count}')
+        lines.append(f'folder_cleaner_move_seconds_sum {report["move_latency"]["sum"]}')
+        lines.append(f'folder_cleaner_move_seconds_count {report["move_latency"]["count"]}')
+        write_atomic(path, "\n".join(lines) + "\n")
+
+
+def write_atomic(path, text) -> None:
+    """
+    Writes `text` to a temp file and renames it over `path` so readers never see half a file.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as report_file:
+        report_file.write(text)
+    os.replace(temp_path, path)
@@ -0,0 +1,261 @@
+import threading, os
+from collections import deque
+
+from utils.transfer import device_id
+
+
+class MoveEngine:
+    """
+    Runs moves on a pool of worker threads with a limit on how many transfers can
+    target the same destination filesystem at once.
+
+    Large files that have to be copied to another filesystem go in their own lane
+    with half of the workers of their device, so the small files and renames in the
+    other lane never wait behind a multi GB copy. A worker whose lane is empty
+    helps with the other one, except that while streaming small lane workers stay
+    free for small files that have yet to arrive.
+    """
+
+    def __init__(
+        self, move_func, per_device=2, stop=None, large_file_size=None, device_func=device_id
+    ) -> None:
+        """
+        Keyword arguments:
+
+        move_func -- called with each queue entry to move it
+
+        per_device -- max concurrent moves per destination filesystem
+
+        stop -- optional threading.Event shared with move_func so copies in progress can be cancelled
+
+        large_file_size -- size in bytes from which a copy goes in the large file lane, None for one lane
+
+        device_func -- returns the device of a folder, such as the device_id of a filesystem backend
+        """
+        self.move_func = move_func
+        self.per_device = max(1, per_device)
+        self.stop = stop if stop is not None else threading.Event()
+        self.large_file_size = large_file_size
+        self.device_func = device_func
+        self.errors = []
+        self.lock = threading.Lock()
+        # destination folder -> st_dev
+        self.dest_devices = {}
+
+    def device_of(self, destination):
+        """
+        Returns the device id for a destination folder, looking each folder up once.
+        """
+        if destination not in self.dest_devices:
+            self.dest_devices[destination] = self.device_func(destination)
+        return self.dest_devices[destination]
+
+    def is_large(self, entry, device) -> bool:
+        """
+        Returns True if an entry is a large file that has to be copied to its device.
+        Same filesystem moves are renames that take no time whatever the size.
+        """
+        if not self.large_file_size or entry["file_size"] < self.large_file_size:
+            return False
+        target = entry.get("target")
+        return target is None or self.device_of(os.path.dirname(target)) != device
+
+    def split_by_device(self, queue):
+        """
+        Splits `queue` into a (small, large) pair of deques per destination device
+        while keeping queue order.
+        """
+        devices = {}
+        for entry in queue:
+            device = self.device_of(entry["destination"])
+            lanes = devices.setdefault(device, (deque(), deque()))
+            lanes[self.is_large(entry, device)].append(entry)
+        return devices
+
+    def lane_workers(self, small_count, large_count):
+        """
+        Returns how many workers of a device start on the small and large lanes.
+        """
+        if not small_count or not large_count or self.per_device == 1:
+            # one lane or one worker so every worker takes whatever is next
+            return min(self.per_device, small_count + large_count), 0
+        large_workers = min(self.per_device // 2, large_count)
+        return min(self.per_device - large_workers, small_count), large_workers
+
+    def move(self, entry, on_done) -> None:
+        """
+        Moves one entry and records its error or reports it as done.
+        """
+        try:
+            self.move_func(entry)
+        except Exception as error:
+            with self.lock:
+                self.errors.append((entry, error))
+            return
+        if on_done:
+            with self.lock:
+                on_done(entry)
+
+    def worker(self, lane, other_lane, on_done) -> None:
+        """
+        Moves entries from a device lane, then from its other lane, until both are
+        empty or the engine is stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                entry = lane.popleft()
+            except IndexError:
+                try:
+                    entry = other_lane.popleft()
+                except IndexError:
+                    return
+            self.move(entry, on_done)
+
+    def run(self, queue, on_done=None):
+        """
+        Moves every entry in `queue` and calls `on_done` for each finished entry.
+        Returns a list of (entry, error) tuples for moves that failed.
+
+        On KeyboardInterrupt the stop event is set so no new moves are started and
+        copies in progress can cancel, then the interrupt is raised once workers exit.
+        """
+        self.stop.clear()
+        self.errors = []
+        threads = []
+        for small, large in self.split_by_device(queue).values():
+            small_workers, large_workers = self.lane_workers(len(small), len(large))
+            lanes = [(small, large)] * small_workers + [(large, small)] * large_workers
+            for lane, other_lane in lanes:
+                thread = threading.Thread(
+                    target=self.worker, args=(lane, other_lane, on_done), daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+            raise
+        return self.errors
+
+    def stream_worker(self, lanes, large, on_done, in_flight) -> None:
+        """
+        Moves entries from the lanes of a device until they are closed and empty.
+        """
+        while True:
+            entry = lanes.get(large)
+            if entry is None:
+                return
+            try:
+                if not self.stop.is_set():
+                    self.move(entry, on_done)
+            finally:
+                in_flight.release()
+
+    def run_stream(self, entries, on_done=None, max_in_flight=1000):
+        """
+        Moves entries from the `entries` iterable as they are produced. At most
+        `max_in_flight` entries are held at once so memory stays constant no matter
+        how many files the iterable yields. Returns the same error list as run.
+        Each device has a small and large lane when it has at least two workers.
+        Large lane workers move small files while no large one is waiting.
+        """
+        self.stop.clear()
+        self.errors = []
+        in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        lanes = {}
+        threads = []
+        try:
+            for entry in entries:
+                if self.stop.is_set():
+                    break
+                # blocks the scan while the movers catch up
+                in_flight.acquire()
+                device = self.device_of(entry["destination"])
+                if device not in lanes:
+                    large_workers = 0
+                    if self.large_file_size and self.per_device > 1:
+                        large_workers = self.per_device // 2
+                    # without large workers every entry goes in the small lane
+                    lanes[device] = StreamLanes(split=bool(large_workers))
+                    for index in range(self.per_device):
+                        thread = threading.Thread(
+                            target=self.stream_worker,
+                            args=(lanes[device], index < large_workers, on_done, in_flight),
+                            daemon=True,
+                        )
+                        thread.start()
+                        threads.append(thread)
+                lanes[device].put(entry, self.is_large(entry, device))
+        except KeyboardInterrupt:
+            self.stop.set()
+            raise
+        finally:
+            for device_lanes in lanes.values():
+                device_lanes.close()
+            try:
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(0.1)
+            except KeyboardInterrupt:
+                self.stop.set()
+                for thread in threads:
+                    thread.join()
+                raise
+        return self.errors
+
+
+class StreamLanes:
+    """
+    The small and large lanes of one device while streaming.
+
+    Workers of the small lane only take small files so they are always free for them,
+    while workers of the large lane take large files first and help with small ones
+    when none are waiting. A device without large files moves small ones with all of
+    its workers this way, and a burst of large copies can never hold every worker.
+    """
+
+    def __init__(self, split=True) -> None:
+        """
+        Keyword arguments:
+
+        split -- keeps large files in their own lane, otherwise every entry is small
+        """
+        self.split = split
+        # (small, large)
+        self.lanes = (deque(), deque())
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, entry, large) -> None:
+        with self.condition:
+            self.lanes[large and self.split].append(entry)
+            # small lane workers can not take a large file so every worker is woken
+            self.condition.notify_all()
+
+    def get(self, large):
+        """
+        Returns the next entry for a worker of the small or large lane, waiting for one,
+        or None once the lanes are closed and have nothing left for the worker.
+        """
+        with self.condition:
+            while True:
+                if self.lanes[large]:
+                    return self.lanes[large].popleft()
+                if large and self.lanes[False]:
+                    return self.lanes[False].popleft()
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+    def close(self) -> None:
+        """
+        Lets workers exit once the lanes they take from are empty.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
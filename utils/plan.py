@@ -0,0 +1,80 @@
+import json, os
+
+from utils.records import QueueEntry, DestinationTable
+
+PLAN_VERSION = 1
+
+
+def write_plan(path, config_hash, watched_folder, moves, deletions, watched_folders=None) -> None:
+    """
+    Writes a move plan as compact JSON.
+
+    Keyword arguments:
+
+    moves -- move_queue entries with a "new_name" key holding the name after renaming
+
+    deletions -- deletion candidate entries
+
+    watched_folders -- every folder that was scanned, defaults to just watched_folder
+    """
+    plan = {
+        "version": PLAN_VERSION,
+        "config_hash": config_hash,
+        "watched_folder": watched_folder,
+        "watched_folders": watched_folders or [watched_folder],
+        # [target, destination, new name, size, mtime]
+        "moves": [
+            [
+                entry["target"],
+                entry["destination"],
+                entry["new_name"],
+                entry["file_size"],
+                entry["mtime"],
+            ]
+            for entry in moves
+        ],
+        # [target, size, mtime]
+        "deletions": [
+            [entry["target"], entry["file_size"], entry["mtime"]] for entry in deletions
+        ],
+    }
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as plan_file:
+        json.dump(plan, plan_file, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def read_plan(path):
+    """
+    Reads a plan written by write_plan and returns it with its moves and deletions
+    turned back into queue entries.
+    """
+    with open(path) as plan_file:
+        plan = json.load(plan_file)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"{path} is not a supported plan file")
+    # plans made before several folders could be watched
+    plan.setdefault("watched_folders", [plan["watched_folder"]])
+    # each destination is parsed once per move so they are shared
+    destinations = DestinationTable()
+    plan["moves"] = [
+        QueueEntry(target, size, destinations.intern(destination), new_name=new_name, mtime=mtime)
+        for target, destination, new_name, size, mtime in plan["moves"]
+    ]
+    plan["deletions"] = [
+        QueueEntry(target, size, mtime=mtime) for target, size, mtime in plan["deletions"]
+    ]
+    return plan
+
+
+def unchanged(entry, stat_func=os.stat) -> bool:
+    """
+    Returns True if the file for a plan entry still exists with the planned size and mtime.
+
+    stat_func -- stat of the filesystem backend the plan is applied with
+    """
+    try:
+        stat = stat_func(entry["target"])
+    except FileNotFoundError:
+        return False
+    return stat.st_size == entry["file_size"] and stat.st_mtime_ns == entry["mtime"]
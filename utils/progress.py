@@ -0,0 +1,107 @@
+import threading, time
+
+# seconds between progress events
+UPDATE_INTERVAL = 0.1
+
+
+class Progress:
+    """
+    Thread safe byte and file counters for a run that report to callbacks at a fixed
+    rate instead of once per file or chunk.
+
+    Chunked copies report bytes as they go so a large file moves the total while it
+    is copied, and each finished file adds whatever its chunks did not report, which
+    is all of it for a rename. Every callback is called with a dict of:
+
+    bytes_done, bytes_total, files_done, files_total -- totals are None when unknown
+
+    bytes_per_second -- average since the run started
+
+    file_name -- name of the file that finished or was copied last
+
+    finished -- True for the last event of the run
+    """
+
+    def __init__(
+        self, bytes_total=None, files_total=None, callbacks=(), interval=UPDATE_INTERVAL
+    ) -> None:
+        self.bytes_total = bytes_total
+        self.files_total = files_total
+        self.callbacks = list(callbacks)
+        self.interval = interval
+        self.lock = threading.Lock()
+        # keeps events from two workers from reaching a callback at the same time
+        self.notify_lock = threading.Lock()
+        self.bytes_done = 0
+        self.files_done = 0
+        self.file_name = None
+        self.started = time.monotonic()
+        self.last_update = 0.0
+
+    def add_bytes(self, count, file_name=None) -> None:
+        """
+        Adds bytes copied by a chunk of a file still being moved.
+        """
+        with self.lock:
+            self.bytes_done += count
+            self.file_name = file_name
+            event = self.due()
+        if event:
+            self.notify(event)
+
+    def file_done(self, remaining, file_name=None) -> None:
+        """
+        Counts a finished file along with the bytes of it that were not reported as chunks.
+        """
+        with self.lock:
+            self.bytes_done += remaining
+            self.files_done += 1
+            self.file_name = file_name
+            event = self.due()
+        if event:
+            self.notify(event)
+
+    def due(self, finished=False):
+        """
+        Returns an event if the update interval has passed since the last one, otherwise None.
+        Called with the lock held.
+        """
+        now = time.monotonic()
+        if not finished and now - self.last_update < self.interval:
+            return None
+        self.last_update = now
+        elapsed = max(now - self.started, 1e-9)
+        return {
+            "bytes_done": self.bytes_done,
+            "bytes_total": self.bytes_total,
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "bytes_per_second": self.bytes_done / elapsed,
+            "file_name": self.file_name,
+            "finished": finished,
+        }
+
+    def notify(self, event) -> None:
+        with self.notify_lock:
+            for callback in self.callbacks:
+                callback(event)
+
+    def close(self) -> None:
+        """
+        Sends the final event so callbacks see the finished totals.
+        """
+        with self.lock:
+            event = self.due(finished=True)
+        self.notify(event)
+
+
+def bar_callback(bar):
+    """
+    Returns a progress callback that moves a tqdm bar to the reported totals.
+    """
+
+    def update(event):
+        bar.update(event["bytes_done"] - bar.n)
+        bar.set_postfix(files=event["files_done"], refresh=False)
+
+    return update
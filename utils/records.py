@@ -0,0 +1,104 @@
+import os
+
+
+class DestinationTable:
+    """
+    Keeps one copy of each destination path so every queue entry going to the same
+    folder points at the same string instead of holding its own.
+    """
+
+    def __init__(self) -> None:
+        self.paths = {}
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def intern(self, path):
+        if path is None:
+            return None
+        return self.paths.setdefault(path, path)
+
+
+class QueueEntry:
+    """
+    A file in the move_queue or a deletion candidate.
+
+    Uses __slots__ so a queue of millions of files costs a few pointers per file
+    instead of a dict each. The file name is read from the target path instead of
+    being stored. Entries can still be read like the dicts they replaced, so
+    entry["destination"] and entry.get("new_name") work, and unset keys count as
+    missing for `in` and get.
+    """
+
+    __slots__ = (
+        "target",
+        "file_size",
+        "destination",
+        "folder",
+        "new_name",
+        "mtime",
+        "duplicate_of",
+    )
+
+    def __init__(
+        self,
+        target,
+        file_size,
+        destination=None,
+        folder=None,
+        new_name=None,
+        mtime=None,
+        duplicate_of=None,
+    ) -> None:
+        self.target = target
+        self.file_size = file_size
+        self.destination = destination
+        self.folder = folder
+        self.new_name = new_name
+        self.mtime = mtime
+        self.duplicate_of = duplicate_of
+
+    @property
+    def file_name(self) -> str:
+        return os.path.basename(self.target)
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in KEY_SET else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        if key not in KEY_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key) -> bool:
+        return key in KEY_SET and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in KEY_SET else None
+        return default if value is None else value
+
+    def as_dict(self):
+        """
+        Returns the keys that are set as a dict.
+        """
+        return {key: getattr(self, key) for key in KEYS if key in self}
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, QueueEntry):
+            other = other.as_dict()
+        if not isinstance(other, dict):
+            return NotImplemented
+        return self.as_dict() == other
+
+    # entries are compared by value so they are kept unhashable like dicts
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"QueueEntry({self.as_dict()})"
+
+
+KEYS = ("file_name",) + QueueEntry.__slots__
+KEY_SET = frozenset(KEYS)
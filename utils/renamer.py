@@ -0,0 +1,90 @@
+import datetime, re
+
+# rename presets starting with this are regular expressions instead of plain text
+REGEX_PREFIX = "re:"
+
+
+class Renamer:
+    """
+    Compiles the file_rename presets once so every file name is renamed in as few
+    scans as possible.
+
+    Plain presets are matched case insensitively and consecutive ones are combined
+    into a single alternation regex. Presets starting with "re:" are regular
+    expressions compiled on their own so their capture groups, backreferences
+    (\\1, \\g<name>) and group names work as written. Presets are applied in the
+    order they are listed and when plain presets overlap the one listed first wins.
+    Replacements can use the templates {date} (today), {mtime} (date the file was
+    last modified) and {counter} (increases with each file renamed using it).
+    """
+
+    def __init__(self, presets) -> None:
+        # (compiled regex, replacements by group name or None, replacement of a regex preset)
+        self.stages = []
+        literals = {}
+        for string, replacement in presets.items():
+            if not string.startswith(REGEX_PREFIX):
+                literals[f"p{len(literals)}"] = (string, replacement)
+                continue
+            self.add_literals(literals)
+            literals = {}
+            pattern = string[len(REGEX_PREFIX) :]
+            try:
+                regex = re.compile(pattern, re.IGNORECASE)
+            except re.error as error:
+                raise ValueError(f"Invalid file_rename preset {string!r}: {error}") from None
+            self.stages.append((regex, None, replacement))
+        self.add_literals(literals)
+        self.uses_mtime = any("{mtime}" in replacement for replacement in presets.values())
+        self.counter = 0
+
+    def add_literals(self, literals) -> None:
+        """
+        Adds a stage matching every plain preset in `literals` in one alternation.
+        """
+        if not literals:
+            return
+        alternatives = [
+            f"(?P<{group}>{re.escape(string)})" for group, (string, _) in literals.items()
+        ]
+        replacements = {group: replacement for group, (_, replacement) in literals.items()}
+        self.stages.append((re.compile("|".join(alternatives), re.IGNORECASE), replacements, None))
+
+    def fill_templates(self, replacement, mtime):
+        """
+        Fills in the date, mtime and counter templates of a replacement.
+        """
+        if "{date}" in replacement:
+            replacement = replacement.replace("{date}", datetime.date.today().isoformat())
+        if "{mtime}" in replacement and mtime is not None:
+            date = datetime.date.fromtimestamp(mtime).isoformat()
+            replacement = replacement.replace("{mtime}", date)
+        if "{counter}" in replacement:
+            self.counter += 1
+            replacement = replacement.replace("{counter}", str(self.counter))
+        return replacement
+
+    def rename(self, file_name, mtime=None):
+        """
+        Returns `file_name` with every preset applied. The original name is kept if
+        renaming would leave nothing before the file type.
+
+        Keyword arguments:
+
+        mtime -- modified time of the file used by the {mtime} template
+        """
+        new_name = file_name
+        for regex, replacements, replacement in self.stages:
+            if replacements is not None:
+                new_name = regex.sub(
+                    lambda match: self.fill_templates(replacements[match.lastgroup], mtime),
+                    new_name,
+                )
+            else:
+                new_name = regex.sub(
+                    lambda match: match.expand(self.fill_templates(replacement, mtime)),
+                    new_name,
+                )
+        if not new_name or new_name[0] == ".":
+            return file_name
+        return new_name
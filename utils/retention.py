@@ -0,0 +1,115 @@
+import heapq, re
+
+# seconds in each duration unit
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+RETENTION_ACTIONS = ["move", "delete"]
+
+
+def parse_duration(value) -> float:
+    """
+    Returns the seconds in a duration such as 90, "10m", "24h" or "3d".
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*", str(value).lower())
+    if not match:
+        raise ValueError(f"Invalid duration {value}")
+    number, unit = match.groups()
+    return float(number) * DURATION_UNITS[unit or "s"]
+
+
+class RetentionRule:
+    """
+    Holds matching files until they have gone unchanged for `min_age` seconds and
+    then moves them to their usual destination or deletes them.
+    """
+
+    def __init__(self, rule) -> None:
+        self.file_types = {file_type.lower() for file_type in rule.get("file_types", [])}
+        self.file_group = rule.get("file_group")
+        self.min_size = rule.get("min_size")
+        self.max_size = rule.get("max_size")
+        self.min_age = parse_duration(rule.get("min_age", 0))
+        self.action = rule.get("action", "move")
+        if self.action not in RETENTION_ACTIONS:
+            raise ValueError(f"Unknown retention action {self.action}")
+
+    def matches(self, file_type, file_group, size) -> bool:
+        if self.file_types and file_type.lower() not in self.file_types:
+            return False
+        if self.file_group and file_group != self.file_group:
+            return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        return True
+
+
+class RetentionRules:
+    """
+    Compiled retention_rules from the config. The first rule a file matches applies.
+    """
+
+    def __init__(self, rules) -> None:
+        self.rules = [RetentionRule(rule) for rule in rules]
+
+    def rule_for(self, file_type, file_group, size):
+        """
+        Returns the first rule matching the file or None.
+        """
+        for rule in self.rules:
+            if rule.matches(file_type, file_group, size):
+                return rule
+        return None
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+
+class DeadlineHeap:
+    """
+    Min-heap of the times held files become eligible so the watch loop can sleep
+    until the earliest one instead of checking every file again.
+
+    Pushing a key again replaces its deadline. Replaced and discarded deadlines stay
+    in the heap and are skipped when they reach the top.
+    """
+
+    def __init__(self) -> None:
+        self.heap = []
+        self.deadlines = {}
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def push(self, deadline, key) -> None:
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+
+    def discard(self, key) -> None:
+        self.deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """
+        Returns the earliest deadline or None if nothing is held.
+        """
+        while self.heap:
+            deadline, key = self.heap[0]
+            if self.deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        """
+        Removes and returns the keys of every deadline at or before `now`, earliest first.
+        """
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > now:
+                return due
+            deadline, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            due.append(key)
@@ -0,0 +1,109 @@
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton that finds every keyword inside a name in a single pass.
+    Keywords are matched case insensitively by lowercasing them and the name.
+    """
+
+    def __init__(self, keywords) -> None:
+        # goto table, failure links and the keyword ids that end at each node
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        # empty keywords are found in every name
+        self.always = []
+        for keyword_id, keyword in enumerate(keywords):
+            keyword = keyword.lower()
+            if not keyword:
+                self.always.append(keyword_id)
+                continue
+            node = 0
+            for char in keyword:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(keyword_id)
+        self.build_failure_links()
+
+    def build_failure_links(self) -> None:
+        """
+        Sets failure links breadth first so each node also reports the keywords
+        that end on its longest proper suffix.
+        """
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, name):
+        """
+        Returns the set of keyword ids found anywhere in `name`.
+        """
+        found = set(self.always)
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for char in name.lower():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return found
+
+
+class RuleIndex:
+    """
+    Compiled form of the routing rules in the config.
+
+    It maps each file extension straight to its file group and base destination
+    and keeps a keyword matcher so a file name only has to be scanned once.
+    Precedence is the same as looping over the raw config: the last file group
+    holding the extension wins, then special cases, then the last matching keyword.
+    """
+
+    def __init__(self, file_type_groups, file_group_dest, special_case_dest, keywords_dest) -> None:
+        keywords = list(keywords_dest.items())
+        # extension -> (file group, destination, keyword ids that can apply)
+        self.extensions = {}
+        for file_group, file_type_list in file_type_groups.items():
+            for file_type in file_type_list:
+                destination = file_group_dest[file_group]
+                if file_type in special_case_dest:
+                    destination = special_case_dest[file_type]
+                candidates = set()
+                for keyword_id, (keyword, keyword_data) in enumerate(keywords):
+                    if file_type in keyword_data[0]:
+                        candidates.add(keyword_id)
+                    elif keyword_data[0] and file_group == keyword_data[0][0]:
+                        candidates.add(keyword_id)
+                self.extensions[file_type] = (file_group, destination, frozenset(candidates))
+        self.keyword_dests = [keyword_data[1] for keyword, keyword_data in keywords]
+        self.matcher = KeywordMatcher([keyword for keyword, keyword_data in keywords])
+
+    def classify(self, file_name, file_type):
+        """
+        Returns the destination for `file_name` or "skip" if no rule matches.
+        """
+        entry = self.extensions.get(file_type)
+        if entry is None:
+            return "skip"
+        file_group, destination, candidates = entry
+        if candidates:
+            matches = candidates.intersection(self.matcher.find(file_name))
+            if matches:
+                destination = self.keyword_dests[max(matches)]
+        return destination
+
+    def file_group(self, file_type):
+        """
+        Returns the file group for `file_type` or None if it is not in any group.
+        """
+        entry = self.extensions.get(file_type)
+        return entry[0] if entry else None
@@ -0,0 +1,68 @@
+import json, os
+
+
+class ScanIndex:
+    """
+    On disk record of files that were already evaluated and left in place so a
+    rescan only classifies new or changed files.
+
+    Files are keyed by their normalized absolute path, so several watched folders can
+    share one index, and remembered with their (size, mtime, inode). The whole index
+    is dropped when the config hash changes since any rule change can change a decision.
+    """
+
+    def __init__(self, path, config_hash) -> None:
+        self.path = path
+        self.config_hash = config_hash
+        self.entries = {}
+        self.seen = set()
+        self.changed = False
+        try:
+            with open(path) as json_file:
+                data = json.load(json_file)
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get("config_hash") == config_hash:
+            self.entries = data["entries"]
+
+    @staticmethod
+    def signature(stat):
+        """
+        Returns the values that change when a file is replaced or modified.
+        """
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def is_known(self, name, stat) -> bool:
+        """
+        Returns True if the file keyed `name` was evaluated before and has not changed since.
+        """
+        self.seen.add(name)
+        return self.entries.get(name) == self.signature(stat)
+
+    def remember(self, name, stat) -> None:
+        """
+        Records that `name` was evaluated and left in place.
+        """
+        self.seen.add(name)
+        self.entries[name] = self.signature(stat)
+        self.changed = True
+
+    def save(self) -> None:
+        """
+        Drops files that were not seen during the scan and writes the index.
+        """
+        for name in list(self.entries):
+            if name not in self.seen:
+                del self.entries[name]
+                self.changed = True
+        if not self.changed:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as json_file:
+            json.dump(
+                {"config_hash": self.config_hash, "entries": self.entries},
+                json_file,
+                separators=(",", ":"),
+            )
+        os.replace(temp_path, self.path)
+        self.changed = False
@@ -0,0 +1,141 @@
+import threading, string, time, os
+
+# fields a sharding template can use
+TEMPLATE_FIELDS = {"year", "month", "day", "name", "type"}
+# characters that are not allowed in folder names on Windows
+INVALID_CHARS = str.maketrans({char: "_" for char in '<>:"\\|?*'})
+
+
+def folder_name(part) -> str:
+    """
+    Makes a formatted template part safe to use as a folder name.
+    """
+    part = part.translate(INVALID_CHARS).strip(" .")
+    return part or "_"
+
+
+class ShardRule:
+    """
+    How files going to one destination are spread over subfolders.
+
+    template -- subfolder path such as "{year}/{month}" or "{name:.2}". year, month and day
+    come from the file mtime, name is the lowercased file name and type its extension.
+
+    max_entries -- files per numbered subfolder (0001, 0002, ...) inside the template folder
+    """
+
+    def __init__(self, rule) -> None:
+        if isinstance(rule, str):
+            rule = {"template": rule}
+        self.template = rule.get("template", "")
+        self.max_entries = rule.get("max_entries")
+        fields = {field for _, field, _, _ in string.Formatter().parse(self.template) if field}
+        unknown = fields - TEMPLATE_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown sharding fields {', '.join(sorted(unknown))}")
+        if not self.template and not self.max_entries:
+            raise ValueError("A sharding rule needs a template or max_entries")
+        self.uses_mtime = bool(fields & {"year", "month", "day"})
+
+    def subfolder(self, file_name, mtime=None) -> str:
+        """
+        Returns the template subfolder for a file as a relative path.
+        """
+        if not self.template:
+            return ""
+        date = time.localtime(mtime) if self.uses_mtime else None
+        file_type = os.path.splitext(file_name)[1][1:].lower()
+        formatted = self.template.format(
+            year=f"{date.tm_year}" if date else "",
+            month=f"{date.tm_mon:02d}" if date else "",
+            day=f"{date.tm_mday:02d}" if date else "",
+            name=file_name.lower(),
+            type=file_type,
+        )
+        return os.path.join(*[folder_name(part) for part in formatted.split("/")])
+
+
+class ShardRules:
+    """
+    Compiled destination_sharding from the config, keyed by destination folder.
+    """
+
+    def __init__(self, rules) -> None:
+        self.rules = {self.key(path): ShardRule(rule) for path, rule in rules.items()}
+        # destination strings as they come from the routing rules -> rule
+        self.lookup = {}
+
+    @staticmethod
+    def key(path) -> str:
+        return os.path.normcase(os.path.normpath(path))
+
+    def rule_for(self, destination):
+        if destination not in self.lookup:
+            self.lookup[destination] = self.rules.get(self.key(destination))
+        return self.lookup[destination]
+
+    def folders(self):
+        """
+        Returns every destination with a sharding rule.
+        """
+        return list(self.rules)
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+
+class Sharder:
+    """
+    Picks the subfolder of a destination each file goes to during a scan.
+
+    Numbered subfolders are filled in order. The last one is listed once through the
+    destination index and files assigned to it are counted as they are queued, so no
+    folder is checked again per file.
+
+    Keyword arguments:
+
+    rules -- ShardRules from the config
+
+    dest_index -- DestinationIndex of the scan
+
+    fs -- filesystem backend used to stat files whose mtime was not passed in
+    """
+
+    def __init__(self, rules, dest_index, fs) -> None:
+        self.rules = rules
+        self.dest_index = dest_index
+        self.fs = fs
+        self.lock = threading.Lock()
+        # template folder -> [number of the last subfolder, files in it]
+        self.numbered = {}
+
+    def shard(self, destination, file_name, stat=None, path=None) -> str:
+        """
+        Returns the folder a file going to `destination` should be placed in,
+        which is `destination` itself when it has no sharding rule.
+        """
+        rule = self.rules.rule_for(destination)
+        if rule == None:
+            return destination
+        mtime = None
+        if rule.uses_mtime:
+            mtime = (stat or self.fs.stat(path)).st_mtime
+        folder = os.path.join(destination, rule.subfolder(file_name, mtime))
+        if rule.max_entries:
+            folder = self.next_numbered(os.path.normpath(folder), rule.max_entries)
+        return os.path.normpath(folder)
+
+    def next_numbered(self, folder, max_entries) -> str:
+        with self.lock:
+            state = self.numbered.get(folder)
+            if state == None:
+                names = self.dest_index.names(folder) or ()
+                numbers = [int(name) for name in names if name.isdigit()]
+                last = max(numbers, default=1)
+                existing = self.dest_index.names(os.path.join(folder, f"{last:04d}"))
+                state = self.numbered[folder] = [last, len(existing or ())]
+            if state[1] >= max_entries:
+                state[0] += 1
+                state[1] = 0
+            state[1] += 1
+            return os.path.join(folder, f"{state[0]:04d}")
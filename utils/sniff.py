@@ -0,0 +1,111 @@
+import json, os
+
+# bytes read from the start of a file to look for a signature
+HEADER_SIZE = 512
+
+# (offset, magic bytes, file type) checked in order so longer signatures come first
+SIGNATURES = [
+    (0, b"\x89PNG\r\n\x1a\n", ".png"),
+    (0, b"\xff\xd8\xff", ".jpg"),
+    (0, b"GIF87a", ".gif"),
+    (0, b"GIF89a", ".gif"),
+    (0, b"II*\x00", ".tif"),
+    (0, b"MM\x00*", ".tif"),
+    (0, b"%PDF-", ".pdf"),
+    (0, b"Rar!\x1a\x07", ".rar"),
+    (0, b"7z\xbc\xaf\x27\x1c", ".7z"),
+    (0, b"!<arch>\ndebian", ".deb"),
+    (0, b"\xed\xab\xee\xdb", ".rpm"),
+    (0, b"PK\x03\x04", ".zip"),
+    (0, b"\x1f\x8b", ".gz"),
+    (257, b"ustar", ".tar"),
+    (0, b"ID3", ".mp3"),
+    (0, b"\xff\xfb", ".mp3"),
+    (0, b"fLaC", ".flac"),
+    (8, b"WAVE", ".wav"),
+    (8, b"AVI ", ".avi"),
+    (4, b"ftypqt", ".mov"),
+    (4, b"ftyp", ".mp4"),
+    (0, b"\x1a\x45\xdf\xa3", ".mkv"),
+    (0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11", ".wmv"),
+    (0, b"\xca\xfe\xba\xbe", ".class"),
+    (0, b"MZ", ".exe"),
+    (0, b"#!/usr/bin/env python", ".py"),
+    (0, b"#!/usr/bin/python", ".py"),
+    (0, b"#!/bin/sh", ".sh"),
+    (0, b"#!/bin/bash", ".sh"),
+    (0, b"#!/usr/bin/env bash", ".sh"),
+]
+
+
+def match_signature(header):
+    """
+    Returns the file type for a file header or None if no signature matches.
+    """
+    for offset, magic, file_type in SIGNATURES:
+        if header[offset : offset + len(magic)] == magic:
+            return file_type
+    return None
+
+
+class Sniffer:
+    """
+    Finds the file type of files whose extension matched no rule by reading their header.
+
+    Results are cached by (inode, size, mtime) and can be saved to disk so repeat
+    scans never read the same header twice.
+    """
+
+    def __init__(self, cache_path=None) -> None:
+        self.cache_path = cache_path
+        self.cache = {}
+        self.seen = set()
+        self.changed = False
+        if cache_path:
+            try:
+                with open(cache_path) as json_file:
+                    self.cache = json.load(json_file)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def sniff(self, path, stat=None):
+        """
+        Returns the file type found in the header of `path` or None.
+        """
+        try:
+            if stat is None:
+                stat = os.stat(path)
+            key = f"{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+            self.seen.add(key)
+            if key in self.cache:
+                return self.cache[key] or None
+            fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        except OSError:
+            return None
+        try:
+            if hasattr(os, "pread"):
+                header = os.pread(fd, HEADER_SIZE, 0)
+            else:
+                header = os.read(fd, HEADER_SIZE)
+        finally:
+            os.close(fd)
+        file_type = match_signature(header)
+        self.cache[key] = file_type or ""
+        self.changed = True
+        return file_type
+
+    def save(self) -> None:
+        """
+        Drops cache entries for files that were not seen and writes the cache.
+        """
+        for key in list(self.cache):
+            if key not in self.seen:
+                del self.cache[key]
+                self.changed = True
+        if not self.cache_path or not self.changed:
+            return
+        temp_path = f"{self.cache_path}.tmp"
+        with open(temp_path, "w") as json_file:
+            json.dump(self.cache, json_file, separators=(",", ":"))
+        os.replace(temp_path, self.cache_path)
+        self.changed = False
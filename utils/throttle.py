@@ -0,0 +1,70 @@
+import threading, platform, ctypes, time, sys, os
+
+# ioprio_set syscall numbers by machine
+IOPRIO_SET = {"x86_64": 251, "amd64": 251, "aarch64": 30, "arm64": 30, "i386": 289, "i686": 289}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+# SetPriorityClass flag that also lowers disk and memory priority
+PROCESS_MODE_BACKGROUND_BEGIN = 0x00100000
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every copy to one destination device so together they stay
+    under `bytes_per_second`. A copy takes tokens after each chunk and sleeps off
+    any debt, with at most one second of unused bandwidth saved up as a burst.
+    """
+
+    def __init__(self, bytes_per_second) -> None:
+        self.rate = bytes_per_second
+        self.tokens = bytes_per_second
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count, cancel=None) -> None:
+        """
+        Takes `count` bytes from the bucket and waits until the bucket is no longer in debt.
+        Returns early if `cancel` is set.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            if cancel is not None:
+                cancel.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+def set_low_io_priority() -> bool:
+    """
+    Lowers the disk and CPU priority of the process so other programs using the same
+    disks go first, like running it under ionice -c3 and nice. Threads started after
+    this inherit it. Returns False if neither priority could be lowered.
+    """
+    if sys.platform == "win32":
+        kernel32 = ctypes.windll.kernel32
+        return bool(
+            kernel32.SetPriorityClass(
+                kernel32.GetCurrentProcess(), PROCESS_MODE_BACKGROUND_BEGIN
+            )
+        )
+    lowered = False
+    if hasattr(os, "nice"):
+        try:
+            os.nice(10)
+            lowered = True
+        except OSError:
+            pass
+    syscall_number = IOPRIO_SET.get(platform.machine().lower())
+    if sys.platform.startswith("linux") and syscall_number:
+        libc = ctypes.CDLL(None, use_errno=True)
+        priority = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+        # 0 is the calling thread, so this runs before any workers start
+        if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, priority) == 0:
+            lowered = True
+    return lowered
@@ -0,0 +1,258 @@
+import tempfile, shutil, errno, sys, os
+
+# bytes copied per kernel call so cancellation is checked often
+CHUNK_SIZE = 8 * 1024 * 1024
+# ioctl that makes a file share the blocks of another on Btrfs, XFS and similar
+FICLONE = 0x40049409
+ORGANIZE_MODES = ["move", "reflink", "hardlink"]
+
+
+class TransferCancelled(Exception):
+    """
+    Raised when a copy is cancelled part way through.
+    """
+
+
+def device_id(path):
+    """
+    Returns the `st_dev` of `path` or of its closest existing parent so destinations
+    that are created during the move still group with the disk they land on.
+    """
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+def kernel_copy(src_fd, dst_fd, offset, count) -> int:
+    """
+    Copies up to `count` bytes at `offset` from `src_fd` to `dst_fd` using the fastest
+    call the platform supports and returns the number of bytes copied.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+        except OSError:
+            # older kernels refuse cross filesystem copy_file_range
+            pass
+    if hasattr(os, "sendfile"):
+        try:
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError:
+            pass
+    return read_write_copy(src_fd, dst_fd, offset, count)
+
+
+def read_write_copy(src_fd, dst_fd, offset, count) -> int:
+    """
+    Copies up to `count` bytes at `offset` through a buffer and returns the number of
+    bytes copied, which is 0 only at the end of the source.
+    """
+    data = os.pread(src_fd, count, offset) if hasattr(os, "pread") else None
+    if data is None:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        data = os.read(src_fd, count)
+    if not data:
+        return 0
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    return os.write(dst_fd, data)
+
+
+def fsync_dir(directory) -> None:
+    """
+    Flushes a directory entry change to disk where the platform allows it.
+    """
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_file(
+    source, destination, cancel=None, chunk_size=CHUNK_SIZE, limiter=None, on_chunk=None
+) -> None:
+    """
+    Copies `source` to a temp file next to `destination` in chunks, fsyncs it and
+    renames it into place. The temp file is removed if the copy fails, ends short of
+    the size the source had when it was opened or `cancel` is set.
+    With a RateLimiter each chunk waits for its share of the device bandwidth and
+    `on_chunk` is called with the byte count of each chunk copied.
+    """
+    directory = os.path.dirname(destination)
+    fd, temp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(destination)}.", suffix=".part", dir=directory
+    )
+    try:
+        with open(source, "rb") as src:
+            src_fd = src.fileno()
+            size = os.fstat(src_fd).st_size
+            offset = 0
+            while offset < size:
+                if cancel is not None and cancel.is_set():
+                    raise TransferCancelled(source)
+                count = min(chunk_size, size - offset)
+                copied = kernel_copy(src_fd, fd, offset, count)
+                if copied == 0:
+                    # some filesystems return 0 from copy_file_range or sendfile before the end
+                    copied = read_write_copy(src_fd, fd, offset, count)
+                if copied == 0:
+                    break
+                offset += copied
+                if on_chunk is not None:
+                    on_chunk(copied)
+                if limiter is not None:
+                    limiter.consume(copied, cancel)
+        if offset != size:
+            # the source shrank while copying so the copy is not committed
+            raise OSError(errno.EIO, f"Copied {offset} of {size} bytes", source)
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        shutil.copystat(source, temp_path)
+        os.replace(temp_path, destination)
+        fsync_dir(directory)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def transfer(
+    source,
+    destination,
+    cancel=None,
+    chunk_size=CHUNK_SIZE,
+    overwrite=False,
+    limiter=None,
+    on_chunk=None,
+) -> str:
+    """
+    Moves `source` to `destination` and returns how it was done.
+
+    A plain rename is used when both are on the same filesystem. Otherwise the file
+    is copied in chunks into a temp file that is renamed into place before the source
+    is removed, so a cancelled or failed copy never leaves a partial file behind.
+
+    Keyword arguments:
+
+    source -- file to move
+
+    destination -- folder or full path to move the file to
+
+    cancel -- optional threading.Event that stops a copy in progress
+
+    overwrite -- replaces an existing file at the destination instead of raising FileExistsError
+
+    limiter -- optional RateLimiter for the destination device, renames are never limited
+
+    on_chunk -- optional function called with the size of each chunk a copy finishes
+    """
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+    if os.path.abspath(source) == os.path.abspath(destination):
+        return "skip"
+    if not overwrite and os.path.exists(destination):
+        raise FileExistsError(destination)
+    if os.stat(source).st_dev == device_id(os.path.dirname(destination)):
+        os.replace(source, destination)
+        return "rename"
+    copy_file(source, destination, cancel, chunk_size, limiter, on_chunk)
+    os.remove(source)
+    return "copy"
+
+
+def reflink(source, destination) -> None:
+    """
+    Makes `destination` a copy-on-write clone of `source` that shares its blocks until
+    either is changed, written to a temp file that is renamed into place. Raises OSError
+    when the filesystem or platform can not clone files.
+    """
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are only supported on Linux")
+    import fcntl
+
+    directory = os.path.dirname(destination)
+    fd, temp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(destination)}.", suffix=".part", dir=directory
+    )
+    try:
+        with open(source, "rb") as src:
+            fcntl.ioctl(fd, FICLONE, src.fileno())
+        os.close(fd)
+        fd = None
+        shutil.copystat(source, temp_path)
+        os.replace(temp_path, destination)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def hardlink(source, destination, overwrite=False) -> None:
+    """
+    Links `source` at `destination`, replacing an existing file if `overwrite` is set.
+    """
+    if not overwrite:
+        os.link(source, destination)
+        return
+    temp_path = f"{destination}.{os.getpid()}.link.part"
+    os.link(source, temp_path)
+    try:
+        os.replace(temp_path, destination)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def link_file(
+    source,
+    destination,
+    cancel=None,
+    mode="reflink",
+    chunk_size=CHUNK_SIZE,
+    overwrite=False,
+    limiter=None,
+    on_chunk=None,
+) -> str:
+    """
+    Places `source` at `destination` without removing it and returns how it was done.
+
+    On the same filesystem the reflink mode clones the file and falls back to a hard
+    link where the filesystem can not clone, and the hardlink mode links it. Nothing
+    is copied unless neither works, which is always the case across filesystems.
+    Keyword arguments are the same as for transfer.
+    """
+    if os.path.isdir(destination):
+        destination = os.path.join(destination, os.path.basename(source))
+    if os.path.abspath(source) == os.path.abspath(destination):
+        return "skip"
+    if not overwrite and os.path.exists(destination):
+        raise FileExistsError(destination)
+    if os.stat(source).st_dev == device_id(os.path.dirname(destination)):
+        if mode == "reflink":
+            try:
+                reflink(source, destination)
+                return "reflink"
+            except OSError:
+                pass
+        try:
+            hardlink(source, destination, overwrite)
+            return "hardlink"
+        except OSError as error:
+            if isinstance(error, FileExistsError):
+                raise
+    copy_file(source, destination, cancel, chunk_size, limiter, on_chunk)
+    return "copy"
@@ -0,0 +1,78 @@
+import os
+
+from utils.filesystem import OSFileSystem
+
+
+class TreeWalk:
+    """
+    Walks a folder tree once with scandir, yielding files for classification while
+    counting what will be left in each folder. Folders that end up with nothing left
+    can then be removed bottom-up without listing them again.
+    """
+
+    def __init__(self, root, excluded=(), fs=None) -> None:
+        """
+        Keyword arguments:
+
+        root -- folder to walk
+
+        excluded -- folders that are never walked into or removed, such as destinations
+
+        fs -- filesystem backend from utils.filesystem, defaults to the real OS
+        """
+        self.fs = fs or OSFileSystem()
+        self.root = os.path.normpath(root)
+        self.excluded = {os.path.normcase(os.path.normpath(path)) for path in excluded}
+        # folder -> number of entries that will stay in it
+        self.kept = {}
+        # folders in the order they finished walking so children come before parents
+        self.order = []
+
+    def files(self):
+        """
+        Yields a DirEntry for every file in the tree.
+        """
+        yield from self.walk(self.root)
+
+    def walk(self, folder):
+        with self.fs.scandir(folder) as scan:
+            entries = list(scan)
+        self.kept[folder] = len(entries)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.normcase(os.path.normpath(entry.path)) in self.excluded:
+                    continue
+                yield from self.walk(entry.path)
+            elif entry.is_file():
+                yield entry
+        self.order.append(folder)
+
+    def claim(self, path) -> None:
+        """
+        Marks a file as leaving its folder because it is being moved or deleted.
+        """
+        self.kept[os.path.dirname(path)] -= 1
+
+    def release(self, path) -> None:
+        """
+        Marks a claimed file as staying in its folder after all.
+        """
+        self.kept[os.path.dirname(path)] += 1
+
+    def prune(self) -> int:
+        """
+        Removes folders that were left with nothing in them, deepest first, and
+        returns how many were removed. The root folder is never removed.
+        """
+        removed = 0
+        for folder in self.order:
+            if folder == self.root or self.kept[folder] > 0:
+                continue
+            try:
+                self.fs.rmdir(folder)
+            except OSError:
+                # something was added or a move failed
+                continue
+            removed += 1
+            self.kept[os.path.dirname(folder)] -= 1
+        return removed
@@ -0,0 +1,152 @@
+import ctypes, ctypes.util, select, struct, stat, time, os
+
+# inotify event flags from sys/inotify.h
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Reports names created or changed in a folder using Linux inotify.
+    """
+
+    def __init__(self, folder) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watch = libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if watch < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"Can not watch {folder}")
+
+    def read(self, timeout=None):
+        """
+        Waits up to `timeout` seconds for events and returns the set of changed names.
+        Returns None if the kernel queue overflowed and the folder needs a full rescan.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if name:
+                    names.add(os.fsdecode(name))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Reports names created or changed in a folder by comparing scandir snapshots.
+    Used where inotify is not available.
+    """
+
+    def __init__(self, folder, interval=2) -> None:
+        self.folder = folder
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        """
+        Returns a dict of file name to (size, mtime) for the folder.
+        """
+        snapshot = {}
+        for entry in os.scandir(self.folder):
+            try:
+                info = entry.stat()
+            except FileNotFoundError:
+                continue
+            snapshot[entry.name] = (info.st_size, info.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout=None):
+        """
+        Sleeps for `timeout` seconds or the poll interval and returns the set of changed names.
+        """
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        snapshot = self.scan()
+        names = {
+            name for name, info in snapshot.items() if self.snapshot.get(name) != info
+        }
+        self.snapshot = snapshot
+        return names
+
+    def close(self) -> None:
+        pass
+
+
+def get_watcher(folder, interval=2):
+    """
+    Returns an inotify watcher on Linux and a polling watcher everywhere else.
+    """
+    if hasattr(os, "O_CLOEXEC") and os.uname().sysname == "Linux":
+        try:
+            return InotifyWatcher(folder)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(folder, interval)
+
+
+class Settler:
+    """
+    Holds changed files until they stop changing so files that are still
+    downloading are not moved half written.
+    """
+
+    def __init__(self, folder, settle_seconds=5, partial_suffixes=()) -> None:
+        self.folder = folder
+        self.settle_seconds = settle_seconds
+        self.partial_suffixes = tuple(suffix.lower() for suffix in partial_suffixes)
+        # name -> (size, mtime, time the file was last seen changing)
+        self.pending = {}
+
+    def add(self, names) -> None:
+        """
+        Adds changed names, restarting their settle window.
+        """
+        for name in names:
+            if name.startswith(".") or name.lower().endswith(self.partial_suffixes):
+                continue
+            self.pending[name] = (None, None, time.monotonic())
+
+    def ready(self):
+        """
+        Returns the names that have not changed for the settle window and drops
+        names that were removed or are not files.
+        """
+        now = time.monotonic()
+        ready = []
+        for name, (size, mtime, changed) in list(self.pending.items()):
+            try:
+                info = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            if not stat.S_ISREG(info.st_mode):
+                del self.pending[name]
+            elif (info.st_size, info.st_mtime_ns) != (size, mtime):
+                self.pending[name] = (info.st_size, info.st_mtime_ns, now)
+            elif now - changed >= self.settle_seconds:
+                del self.pending[name]
+                ready.append(name)
+        return ready